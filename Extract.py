@@ -1,10 +1,17 @@
 import json
 
+import instrument
+import jsonl_io
+
+input_file = "rated-text-adventures.jsonl"
+output_file = "Sic-text-adventures.jsonl"
+
 def filter_jsonl(input_file, output_file):
-    with open(input_file, 'r') as infile, open(output_file, 'w') as outfile:
+    with jsonl_io.open_jsonl(input_file, 'r') as infile, jsonl_io.open_jsonl(output_file, 'w') as outfile:
         for idx, line in enumerate(infile, 1):
             try:
-                obj = json.loads(line)
+                with instrument.phase("parse"):
+                    obj = json.loads(line)
             except json.JSONDecodeError:
                 print(f"Line {idx} in {input_file} is garbage JSON: {line.strip()}")
                 continue
@@ -12,8 +19,17 @@ def filter_jsonl(input_file, output_file):
             evaluation = obj.get("evaluation")
             if (isinstance(evaluation, int) and 4 <= evaluation <= 6) or (
                 isinstance(evaluation, dict) and 4 <= evaluation.get("rating", 0) <= 6):
-                outfile.write(json.dumps(obj) + '\n')
+                with instrument.phase("write"):
+                    outfile.write(json.dumps(obj) + '\n')
             else:
                 print(f"Line {idx} skipped. Evaluation doesn't match criteria or is nonsense: {evaluation}")
 
-filter_jsonl("rated-text-adventures.jsonl", "Sic-text-adventures.jsonl")
\ No newline at end of file
+
+def main():
+    instrument.start("extract")
+    filter_jsonl(input_file, output_file)
+    instrument.report()
+
+
+if __name__ == "__main__":
+    main()
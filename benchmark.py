@@ -0,0 +1,305 @@
+import argparse
+import json
+import os
+import platform
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+import orjson
+
+from stages import STAGES, load_stage
+
+output_file = "bench-results.json"
+num_records = 20000
+worker_counts = [1, 2, 4, 8]
+seed = 1234
+
+# Corpus shape
+length_mu = 6.0  # log of the median document length in words
+length_sigma = 1.0
+min_words = 5
+max_words = 20000
+duplicate_rate = 0.05  # Share of records that are exact copies of an earlier one
+near_duplicate_rate = 0.05  # Share of records that are lightly edited copies
+near_duplicate_edits = 0.03  # Fraction of words changed in a near-duplicate
+language_mix = {"en": 0.85, "de": 0.05, "fr": 0.04, "es": 0.03, "it": 0.03}
+
+# Stages that take a num_workers setting get benchmarked at every worker count
+PARALLEL_STAGES = ("prune", "lang-filter", "tokenizing", "dedupe-fuzz")
+
+WORDS = {
+    "en": "the of and to in is was he for it with as his on be at by had not are but from or have an they which "
+          "one you were her all she there would their we him been has when who will more no if out so said what up "
+          "its about into than them can only other new some could time these two may then do first any my now such "
+          "like our over man me even most made after also did many before must through back years where much your "
+          "way well down should because each just those people how too little state good very make world still own "
+          "see men work long get here between both life being under never day same another know while last might us "
+          "great old year off come since against go came right used take three dark night door sword castle river",
+    "de": "der die und in den von zu das mit sich des auf für ist im dem nicht ein die eine als auch es an werden aus "
+          "er hat dass sie nach wird bei einer um am sind noch wie einem über einen so zum war haben nur oder aber "
+          "vor zur bis mehr durch man sein wurde sei ihr seine kann gegen vom schon wenn habe seiner diese ihre "
+          "dann unter wir soll ich eines jahr zwei jahren dieser wieder keine seinem ob dir allen großen nacht tür",
+    "fr": "de la le et les des en un du une que est pour qui dans par plus pas au sur ne se sont il ce avec son "
+          "mais comme ou été aux elle cette ses nous leur bien aussi deux fait sans tout peut même entre elles "
+          "dont sous ont sa lui nos vous fois avoir être très après où encore avant ces donc leurs jour nuit porte",
+    "es": "de la que el en y a los del se las por un para con no una su al lo como más pero sus le ya o este sí "
+          "porque esta entre cuando muy sin sobre también me hasta hay donde quien desde todo nos durante todos uno "
+          "les ni contra otros ese eso ante ellos e esto mí antes algunos qué unos yo otro otras otra él noche puerta",
+    "it": "di e il la che in un a per è non una sono del le si da con i mi ma lo come ho dei ha ti cosa se io al "
+          "anche ci gli questo più della nel alla tutto bene ne mio sei hai era così fatto solo detto mia lei lui "
+          "dove quando niente ora fare ancora qui loro tu chi tutti casa notte porta sempre molto prima dopo",
+}
+
+
+def make_text(rng, lang):
+    words = WORDS[lang].split()
+    count = int(rng.lognormvariate(length_mu, length_sigma))
+    count = min(max(count, min_words), max_words)
+    sentences = []
+    while count > 0:
+        n = min(count, rng.randint(6, 20))
+        sentence = " ".join(rng.choice(words) for _ in range(n))
+        sentences.append(sentence.capitalize() + ".")
+        count -= n
+    return " ".join(sentences)
+
+
+def perturb(rng, text, lang):
+    words = text.split(" ")
+    vocab = WORDS[lang].split()
+    for _ in range(max(1, int(len(words) * near_duplicate_edits))):
+        words[rng.randrange(len(words))] = rng.choice(vocab)
+    return " ".join(words)
+
+
+def generate_corpus(path, records=None, seed_value=None):
+    """
+    Write a synthetic scrape to `path`. Every record carries the fields the
+    different stages look at ("content", "text", "evaluation") plus a few that
+    prune.py should drop.
+    """
+    rng = random.Random(seed if seed_value is None else seed_value)
+    records = num_records if records is None else records
+    langs, weights = zip(*language_mix.items())
+    history = []  # (text, lang) of originals we can copy from
+    counts = {"unique": 0, "duplicate": 0, "near_duplicate": 0}
+
+    with open(path, "wb") as outfile:
+        for idx in range(records):
+            roll = rng.random()
+            if history and roll < duplicate_rate:
+                text, lang = rng.choice(history)
+                counts["duplicate"] += 1
+            elif history and roll < duplicate_rate + near_duplicate_rate:
+                text, lang = rng.choice(history)
+                text = perturb(rng, text, lang)
+                counts["near_duplicate"] += 1
+            else:
+                lang = rng.choices(langs, weights)[0]
+                text = make_text(rng, lang)
+                history.append((text, lang))
+                counts["unique"] += 1
+
+            record = {
+                "id": idx,
+                "title": f"Story {idx}",
+                "content": text,
+                "text": text,
+                "evaluation": rng.randint(1, 6),
+                "author": f"user{rng.randint(0, 999)}",
+                "tags": rng.sample(["adventure", "horror", "romance", "scifi", "comedy"], 2),
+                "url": f"https://example.invalid/s/{idx}",
+            }
+            outfile.write(orjson.dumps(record, option=orjson.OPT_APPEND_NEWLINE))
+
+    return {"records": records, "bytes": os.path.getsize(path), **counts}
+
+
+def build_tokenizer(corpus_path, path):
+    """
+    Train a small word-level tokenizer on the synthetic corpus and save it as
+    a tokenizer.json, so tokenizing.py runs without the network.
+    """
+    from tokenizers import Tokenizer, models, pre_tokenizers, trainers
+
+    tokenizer = Tokenizer(models.WordLevel(unk_token="[UNK]"))
+    tokenizer.pre_tokenizer = pre_tokenizers.Whitespace()
+    trainer = trainers.WordLevelTrainer(vocab_size=4096, special_tokens=["[UNK]"])
+
+    def texts():
+        with open(corpus_path, "rb") as infile:
+            for line in infile:
+                yield orjson.loads(line)["text"]
+
+    tokenizer.train_from_iterator(texts(), trainer)
+    tokenizer.save(path)
+    return path
+
+
+def run_stage(name, overrides, result_file):
+    """
+    Entry point of the per-stage subprocess: run the stage and dump timings.
+    """
+    module = load_stage(name, **overrides)
+    start = time.perf_counter()
+    cpu_start = os.times()
+    module.main()
+    seconds = time.perf_counter() - start
+    cpu_end = os.times()
+
+    own = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    with open(result_file, "wb") as outfile:
+        outfile.write(orjson.dumps({
+            "seconds": seconds,
+            "cpu_seconds": sum(cpu_end[:4]) - sum(cpu_start[:4]),
+            # ru_maxrss is in KiB on Linux; children covers reaped Pool workers
+            "peak_rss_mb": max(own.ru_maxrss, children.ru_maxrss) / 1024,
+            "peak_parent_rss_mb": own.ru_maxrss / 1024,
+            "peak_worker_rss_mb": children.ru_maxrss / 1024,
+        }))
+
+
+def count_lines(path):
+    with open(path, "rb") as infile:
+        return sum(1 for _ in infile)
+
+
+def bench_stage(name, input_path, workdir, workers, extra):
+    output_path = os.path.join(workdir, f"{name}-w{workers}.jsonl")
+    overrides = {"input_file": input_path, "output_file": output_path, **extra}
+    if name in PARALLEL_STAGES:
+        overrides["num_workers"] = workers
+    result_file = os.path.join(workdir, f"{name}-w{workers}.result.json")
+
+    proc = subprocess.run(
+        [sys.executable, os.path.abspath(__file__), "--run-stage", name,
+         "--overrides", json.dumps(overrides), "--result-file", result_file],
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.PIPE,
+        cwd=workdir,
+    )
+    if proc.returncode != 0:
+        print(f"{name} (workers={workers}) failed:\n{proc.stderr.decode(errors='replace')[-2000:]}")
+        return None
+
+    with open(result_file, "rb") as infile:
+        result = orjson.loads(infile.read())
+
+    input_records = count_lines(input_path)
+    input_mb = os.path.getsize(input_path) / (1024 * 1024)
+    result.update({
+        "stage": name,
+        "workers": workers if name in PARALLEL_STAGES else 1,
+        "input_records": input_records,
+        "output_records": count_lines(output_path),
+        "records_per_s": input_records / result["seconds"],
+        "mb_per_s": input_mb / result["seconds"],
+    })
+    return result
+
+
+def run_benchmarks(stages, workdir, records):
+    corpus_path = os.path.join(workdir, "corpus.jsonl")
+    corpus = generate_corpus(corpus_path, records)
+    print(f"Generated corpus: {corpus}")
+
+    extra = {}
+    if "tokenizing" in stages:
+        extra["tokenizing"] = {"tokenizer_file": build_tokenizer(corpus_path, os.path.join(workdir, "tokenizer.json"))}
+
+    counts = sorted({min(w, os.cpu_count() or 1) for w in worker_counts})
+    results = []
+    for name in stages:
+        for workers in (counts if name in PARALLEL_STAGES else [1]):
+            # Every stage reads the same raw corpus so numbers don't depend
+            # on what the previous stage happened to drop
+            result = bench_stage(name, corpus_path, workdir, workers, extra.get(name, {}))
+            if result is None:
+                continue
+            print(f"{name:>13} workers={result['workers']:<3} {result['records_per_s']:>10.1f} rec/s "
+                  f"{result['mb_per_s']:>8.2f} MB/s  peak RSS {result['peak_rss_mb']:.0f} MB")
+            results.append(result)
+
+    scaling = {}
+    for name in stages:
+        runs = {r["workers"]: r["seconds"] for r in results if r["stage"] == name}
+        if 1 in runs and len(runs) > 1:
+            scaling[name] = {str(w): runs[1] / s for w, s in sorted(runs.items())}
+
+    return {"corpus": corpus, "results": results, "scaling": scaling}
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"], capture_output=True, text=True,
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+        ).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def compare(old_path, new_report):
+    """
+    Print the records/s change per stage and worker count against an older report.
+    """
+    with open(old_path, "rb") as infile:
+        old = orjson.loads(infile.read())
+    old_runs = {(r["stage"], r["workers"]): r for r in old["results"]}
+    for run in new_report["results"]:
+        before = old_runs.get((run["stage"], run["workers"]))
+        if before is None:
+            continue
+        change = (run["records_per_s"] / before["records_per_s"] - 1) * 100
+        print(f"{run['stage']:>13} workers={run['workers']:<3} {before['records_per_s']:>10.1f} -> "
+              f"{run['records_per_s']:>10.1f} rec/s ({change:+.1f}%)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the pipeline stages on a synthetic corpus")
+    parser.add_argument("--records", type=int, default=num_records)
+    parser.add_argument("--stages", nargs="+", default=list(STAGES), choices=list(STAGES))
+    parser.add_argument("--output", default=output_file)
+    parser.add_argument("--compare", help="Earlier report to compare against")
+    parser.add_argument("--workdir", help="Keep the corpus and stage outputs here")
+    parser.add_argument("--run-stage", help=argparse.SUPPRESS)
+    parser.add_argument("--overrides", help=argparse.SUPPRESS)
+    parser.add_argument("--result-file", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run_stage:
+        run_stage(args.run_stage, json.loads(args.overrides), args.result_file)
+        return
+
+    if args.workdir:
+        os.makedirs(args.workdir, exist_ok=True)
+        report = run_benchmarks(args.stages, os.path.abspath(args.workdir), args.records)
+    else:
+        with tempfile.TemporaryDirectory(prefix="orion-bench-") as workdir:
+            report = run_benchmarks(args.stages, workdir, args.records)
+
+    report.update({
+        "commit": git_commit(),
+        "python": platform.python_version(),
+        "cpu_count": os.cpu_count(),
+        "settings": {
+            "length_mu": length_mu, "length_sigma": length_sigma,
+            "duplicate_rate": duplicate_rate, "near_duplicate_rate": near_duplicate_rate,
+            "language_mix": language_mix, "seed": seed,
+        },
+    })
+    with open(args.output, "wb") as outfile:
+        outfile.write(orjson.dumps(report, option=orjson.OPT_INDENT_2))
+    print(f"Wrote {args.output}")
+
+    if args.compare:
+        compare(args.compare, report)
+
+
+if __name__ == "__main__":
+    main()
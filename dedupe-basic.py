@@ -1,26 +1,48 @@
 import orjson
 from tqdm import tqdm
 
+import instrument
+import jsonl_io
+from fingerprints import FingerprintDB, content_hash
+
 input_file = "tokenized-ass.jsonl"
 output_file = "deduped_ass.jsonl"
+fingerprint_db = None  # e.g. "fingerprints.sqlite" to also drop content kept by earlier runs
 
 def main():
+    instrument.start("dedupe-basic")
     seen_contents = set()  # Store unique content
     unique_records = []
+    db = FingerprintDB(fingerprint_db) if fingerprint_db else None
 
-    with open(input_file, "r") as infile:
+    with jsonl_io.open_jsonl(input_file, "r") as infile:
         for line in tqdm(infile, desc="Deduplicating"):
-            record = orjson.loads(line)
+            with instrument.phase("parse"):
+                record = orjson.loads(line)
             content = record.get("content", "")
 
-            if content not in seen_contents:
+            with instrument.phase("compute"):
+                if content in seen_contents:
+                    continue
                 seen_contents.add(content)
+                if db is not None:
+                    digest = content_hash(content)
+                    if db.has_exact(digest):
+                        continue  # Kept by an earlier batch
+                    db.add(digest)
                 unique_records.append(record)
 
-    with open(output_file, "w") as outfile:
+    with instrument.phase("write"), jsonl_io.open_jsonl(output_file, "w") as outfile:
         for record in unique_records:
             outfile.write(orjson.dumps(record).decode("utf-8") + "\n")
 
+    if db is not None:
+        # Only remember this batch once its output is safely written
+        db.commit()
+        db.close()
+
+    instrument.report()
+
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -1,22 +1,33 @@
 from rapidfuzz import fuzz, process
+import mmap
+import numpy as np
 import orjson
 from multiprocessing import Pool, Manager
 from tqdm import tqdm
 
+import instrument
+import jsonl_io
+from fingerprints import FingerprintDB, UnionFind, candidate_pairs, content_hash, minhash
+
 input_file = "Text.jsonl"
 output_file = "filtered_file.jsonl"
 similarity_threshold = 85  # Percentage threshold for similarity
 num_workers = 15  # Use your available cores
 batch_size = 1000  # Number of records per chunk
+fingerprint_db = None  # e.g. "fingerprints.sqlite" to also drop near-duplicates of earlier runs
+mode = "chunked"  # "cluster" compares across the whole corpus, same result for any num_workers
+keep = "longest"  # Which record of a cluster survives: "longest" or "lowest_id"
+cluster_map_file = "clusters.jsonl"  # Written in cluster mode, one line per duplicate cluster
 
 
 def is_similar(new_content, seen_contents):
     """
     Check for similarity to already-seen contents using RapidFuzz.
     """
-    matches = process.extract(
-        new_content, seen_contents, scorer=fuzz.ratio, limit=1
-    )  # Check against limited candidates
+    with instrument.phase("compute"):
+        matches = process.extract(
+            new_content, seen_contents, scorer=fuzz.ratio, limit=1
+        )  # Check against limited candidates
     if matches and matches[0][1] >= similarity_threshold:
         return True
     return False
@@ -24,15 +35,19 @@ def is_similar(new_content, seen_contents):
 
 def process_chunk(chunk, shared_seen_contents, lock, chunk_id=0):
     """
-    Deduplicate a chunk of records.
+    Deduplicate one chunk of the input (see chunk_lines). Only the line numbers
+    of the kept records go back to the parent, which copies those lines itself.
     """
     local_seen = set()  # A local set to avoid duplicates within this chunk
-    unique_records = []  # List of unique records to return
+    kept = []  # Line numbers of the unique records
+    signatures = []  # MinHash signatures of the kept records, only with fingerprint_db
+    digests = []  # And their exact hashes
     skipped_records = 0  # Counter for skipped records
 
-    for line in tqdm(chunk, desc=f"Chunk {chunk_id}", leave=False):
+    for index, line in tqdm(chunk_lines(chunk), desc=f"Chunk {chunk_id}", leave=False):
         try:
-            record = orjson.loads(line)
+            with instrument.phase("parse"):
+                record = orjson.loads(line)
             content = record.get("text", "")
 
             if not content:
@@ -40,7 +55,7 @@ def process_chunk(chunk, shared_seen_contents, lock, chunk_id=0):
                 skipped_records += 1
                 continue
 
-            with lock:
+            with instrument.phase("ipc"), lock:
                 if content in shared_seen_contents:
                     # Already globally seen; skip this record
                     skipped_records += 1
@@ -49,7 +64,11 @@ def process_chunk(chunk, shared_seen_contents, lock, chunk_id=0):
             # Perform fuzzy matching locally
             if not is_similar(content, local_seen):
                 local_seen.add(content)
-                unique_records.append(record)
+                kept.append(index)
+                if fingerprint_db:
+                    with instrument.phase("compute"):
+                        signatures.append(minhash(content))
+                        digests.append(content_hash(content))
             else:
                 # Fuzzy match too similar; skip record
                 skipped_records += 1
@@ -57,39 +76,285 @@ def process_chunk(chunk, shared_seen_contents, lock, chunk_id=0):
             print(f"Error processing record: {e}")
             skipped_records += 1
 
-    with lock:
+    with instrument.phase("ipc"), lock:
         # Fixed update mechanism for ListProxy object
         for item in local_seen:
             if item not in shared_seen_contents:
                 shared_seen_contents.append(item)
 
-    print(f"Chunk {chunk_id} processed. Unique records: {len(unique_records)}, Skipped records: {skipped_records}")
-    return unique_records
+    print(f"Chunk {chunk_id} processed. Unique records: {len(kept)}, Skipped records: {skipped_records}")
+    signatures = np.array(signatures, dtype=np.uint32).reshape(len(signatures), -1 if signatures else 0)
+    return np.array(kept, dtype=np.int64), signatures, digests
+
+
+def drop_known(results, db):
+    """
+    Check this batch's survivors against the fingerprint store, in input
+    order, adding each kept record so later ones are checked against it too.
+    """
+    kept = []
+    for indices, signatures, digests in results:
+        for index, signature, digest in zip(indices.tolist(), signatures, digests):
+            if db.has_exact(digest) or db.find_near(signature) is not None:
+                continue
+            db.add(digest, signature)
+            kept.append(index)
+    return kept
+
+
+_source = None  # (mmap of the input, line offsets) inside workers, and in the parent while writing
+
+
+def open_source(path, offsets):
+    global _source
+    with open(path, "rb") as infile:
+        data = mmap.mmap(infile.fileno(), 0, access=mmap.ACCESS_READ) if offsets[-1] else b""
+    _source = (data, offsets)
+    return data
+
+
+def init_cluster_worker(path, offsets):
+    instrument.worker_init()
+    open_source(path, offsets)
+
+
+def chunk_lines(chunk):
+    """
+    (line number, raw line) pairs of a chunk: either a (start, end) range of
+    the mmapped input, or (start, lines) streamed from a compressed one.
+    """
+    start, lines = chunk
+    if isinstance(lines, list):
+        return enumerate(lines, start)
+    data, offsets = _source
+    return ((index, data[offsets[index]:offsets[index + 1]]) for index in range(start, lines))
+
+
+def stream_chunks(path):
+    """
+    Read a compressed input in chunks of batch_size lines, as (start, lines).
+    """
+    start, lines = 0, []
+    with jsonl_io.open_jsonl(path, "rb") as infile:
+        for line in infile:
+            lines.append(line)
+            if len(lines) >= batch_size:
+                yield start, lines
+                start, lines = start + len(lines), []
+    if lines:
+        yield start, lines
+
+
+def stream_kept(path, kept):
+    """
+    Second pass over a compressed input, yielding the lines numbered in `kept` (sorted).
+    """
+    wanted = iter(kept)
+    target = next(wanted, None)
+    with jsonl_io.open_jsonl(path, "rb") as infile:
+        for index, line in enumerate(infile):
+            if target is None:
+                break
+            if index == target:
+                yield line
+                target = next(wanted, None)
+
+
+def read_record(index):
+    data, offsets = _source
+    return orjson.loads(data[offsets[index]:offsets[index + 1]])
+
+
+def line_offsets(path):
+    """
+    Byte offset of every line start, plus the file size at the end.
+    """
+    offsets = [0]
+    with open(path, "rb") as infile:
+        for line in infile:
+            offsets.append(offsets[-1] + len(line))
+    return np.array(offsets, dtype=np.int64)
+
+
+def signature_range(bounds):
+    """
+    Phase 1a: MinHash signature, exact hash, length and id of lines [start, end).
+    """
+    start, end = bounds
+    signatures = []
+    info = []  # (content hash or None for empty records, length, id)
+    for index in range(start, end):
+        try:
+            with instrument.phase("parse"):
+                record = read_record(index)
+            content = record.get("text", "")
+        except Exception as e:
+            print(f"Error processing record {index}: {e}")
+            content, record = "", {}
+        if not content:
+            signatures.append(np.zeros(0, dtype=np.uint32))
+            info.append((None, 0, None))
+            continue
+        with instrument.phase("compute"):
+            signatures.append(minhash(content))
+        info.append((content_hash(content), len(content), record.get("id")))
+    return signatures, info
+
+
+def verify_pairs(pairs):
+    """
+    Phase 1b: keep the candidate pairs that really are similar by fuzz.ratio.
+    """
+    texts = {}
+    verified = np.zeros(len(pairs), dtype=bool)
+    for n, (a, b) in enumerate(pairs):
+        for index in (a, b):
+            if index not in texts:
+                with instrument.phase("parse"):
+                    texts[index] = read_record(index).get("text", "")
+        with instrument.phase("compute"):
+            verified[n] = fuzz.ratio(texts[a], texts[b]) >= similarity_threshold
+    return verified
+
+
+def pick_representative(members, info):
+    if keep == "lowest_id":
+        def id_key(i):
+            # Numeric ids sort numerically, then string ids, then records without one
+            record_id = info[i][2]
+            if isinstance(record_id, (int, float)):
+                return (0, record_id, "", i)
+            return (1 if record_id is not None else 2, 0, str(record_id), i)
+        return min(members, key=id_key)
+    return min(members, key=lambda i: (-info[i][1], i))
+
+
+def cluster_dedupe(path):
+    offsets = line_offsets(path)
+    total = len(offsets) - 1
+    print(f"Total lines in input file: {total}")
+    if total == 0:
+        return [], offsets, {}
+
+    step = max(1, min(batch_size, -(-total // num_workers)))
+    ranges = [(start, min(start + step, total)) for start in range(0, total, step)]
+
+    with Pool(num_workers, initializer=init_cluster_worker, initargs=(path, offsets)) as pool:
+        signatures, info = [], []
+        for chunk_signatures, chunk_info in tqdm(
+            pool.imap(instrument.task(signature_range), ranges), desc="Signatures", total=len(ranges)
+        ):
+            signatures.extend(chunk_signatures)
+            info.extend(chunk_info)
+
+        union = UnionFind(total)
+        # Identical content is merged straight away, only one copy goes through LSH
+        first_by_hash = {}
+        for index, (digest, _, _) in enumerate(info):
+            if digest is None:
+                continue
+            if digest in first_by_hash:
+                union.union(first_by_hash[digest], index)
+            else:
+                first_by_hash[digest] = index
+        distinct = np.array(sorted(first_by_hash.values()), dtype=np.int64)
+
+        with instrument.phase("compute"):
+            pairs = candidate_pairs(np.stack([signatures[i] for i in distinct])) if len(distinct) else []
+            pairs = distinct[pairs] if len(pairs) else np.empty((0, 2), dtype=np.int64)
+        print(f"{len(pairs)} candidate pairs from {len(distinct)} distinct records")
+
+        pair_chunks = [pairs[i:i + batch_size] for i in range(0, len(pairs), batch_size)]
+        verified = list(tqdm(
+            pool.imap(instrument.task(verify_pairs), pair_chunks), desc="Verifying pairs", total=len(pair_chunks)
+        ))
+        pool.close()
+        pool.join()
+
+    for chunk, mask in zip(pair_chunks, verified):
+        for a, b in chunk[mask]:
+            union.union(int(a), int(b))
+
+    # Phase 2: one deterministic survivor per cluster
+    kept = []
+    clusters = {}
+    for members in union.clusters().values():
+        members = [i for i in members if info[i][0] is not None]  # Empty records are dropped
+        if not members:
+            continue
+        representative = pick_representative(members, info)
+        kept.append(representative)
+        if len(members) > 1:
+            clusters[representative] = [i for i in members if i != representative]
+    kept.sort()
+    return kept, offsets, {"info": info, "signatures": signatures, "clusters": clusters}
+
+
+def cluster_main():
+    with jsonl_io.plain_copy(input_file) as path:
+        kept, offsets, details = cluster_dedupe(path)
+        info = details.get("info", [])
+
+        db = None
+        if fingerprint_db and kept:
+            db = FingerprintDB(fingerprint_db)
+            survivors = []
+            for index in kept:
+                digest, signature = info[index][0], details["signatures"][index]
+                if db.has_exact(digest) or db.find_near(signature) is not None:
+                    continue
+                db.add(digest, signature)
+                survivors.append(index)
+            print(f"Dropped {len(kept) - len(survivors)} records already in {fingerprint_db}")
+            kept = survivors
+
+        print(f"Total unique records after processing: {len(kept)}")
+
+        # Copy the kept lines byte for byte, no re-serialization
+        with instrument.phase("write"), open(path, "rb") as infile, \
+                jsonl_io.open_jsonl(output_file, "wb") as outfile:
+            data = mmap.mmap(infile.fileno(), 0, access=mmap.ACCESS_READ) if len(offsets) > 1 else b""
+            for index in kept:
+                line = data[offsets[index]:offsets[index + 1]]
+                outfile.write(line if line.endswith(b"\n") else line + b"\n")
+
+    with jsonl_io.open_jsonl(cluster_map_file, "wb") as outfile:
+        for representative, duplicates in sorted(details.get("clusters", {}).items()):
+            outfile.write(orjson.dumps({
+                "kept": {"line": representative + 1, "id": info[representative][2]},
+                "removed": [{"line": i + 1, "id": info[i][2]} for i in duplicates],
+            }, option=orjson.OPT_APPEND_NEWLINE))
+    print(f"Wrote {len(details.get('clusters', {}))} duplicate clusters to {cluster_map_file}")
+
+    if db is not None:
+        db.commit()
+        db.close()
 
 
 def main():
-    # Count total lines for better progress tracking
-    total_lines = 0
-    with open(input_file, "r") as infile:
-        for _ in tqdm(infile, desc="Counting lines"):
-            total_lines += 1
-            
+    if mode not in ("chunked", "cluster"):
+        raise ValueError(f"Unknown mode: {mode}")
+    if keep not in ("longest", "lowest_id"):
+        raise ValueError(f"Unknown keep rule: {keep}")
+    instrument.start("dedupe-fuzz")
+    if mode == "cluster":
+        cluster_main()
+        instrument.report()
+        return
+
+    compressed = jsonl_io.codec(input_file) is not None
+    if compressed:
+        # Streamed twice (chunks now, kept lines at the end) instead of decompressed to disk
+        chunks = list(stream_chunks(input_file))
+        total_lines = sum(len(lines) for _, lines in chunks)
+        initializer, initargs = instrument.worker_init, ()
+    else:
+        # Chunks are just line ranges, workers read their lines from the mmapped input
+        offsets = line_offsets(input_file)
+        total_lines = len(offsets) - 1
+        chunks = [(start, min(start + batch_size, total_lines)) for start in range(0, total_lines, batch_size)]
+        initializer, initargs = init_cluster_worker, (input_file, offsets)
     print(f"Total lines in input file: {total_lines}")
-    
-    # Read file in chunks for streaming
-    chunks = []
-    with open(input_file, "r") as infile:
-        current_chunk = []
-        for i, line in enumerate(tqdm(infile, desc="Creating chunks", total=total_lines)):
-            current_chunk.append(line)
-            if len(current_chunk) >= batch_size:
-                chunks.append(current_chunk)
-                current_chunk = []
-                
-        # Add the last chunk if not empty
-        if current_chunk:
-            chunks.append(current_chunk)
-            
     print(f"Created {len(chunks)} chunks for processing")
 
     # Set up shared memory using Manager
@@ -98,27 +363,50 @@ def main():
     lock = manager.Lock()
 
     # Use multiprocessing to process each chunk
-    with Pool(num_workers) as pool:
+    with Pool(num_workers, initializer=initializer, initargs=initargs) as pool:
         results = list(
             tqdm(
                 pool.starmap(
-                    process_chunk,
+                    instrument.task(process_chunk),
                     [(chunk, shared_seen_contents, lock, i) for i, chunk in enumerate(chunks)],
                 ),
                 desc="Multiprocessing fuzzy deduplication",
                 total=len(chunks),
             )
         )
+        pool.close()
+        pool.join()
+    del chunks
+
+    # Line numbers of the unique records, in input order
+    kept = [index for indices, _, _ in results for index in indices.tolist()]
+
+    db = None
+    if fingerprint_db:
+        db = FingerprintDB(fingerprint_db)
+        with instrument.phase("compute"):
+            known = len(kept)
+            kept = drop_known(results, db)
+        print(f"Dropped {known - len(kept)} records already in {fingerprint_db}")
+
+    print(f"Total unique records after processing: {len(kept)}")
 
-    # Flatten all the unique records from the multiprocessing results
-    filtered_records = [record for chunk_results in results for record in chunk_results]
+    # Copy the kept lines byte for byte, no re-serialization
+    if compressed:
+        lines = stream_kept(input_file, kept)
+    else:
+        data = open_source(input_file, offsets)
+        lines = (data[offsets[index]:offsets[index + 1]] for index in kept)
+    with instrument.phase("write"), jsonl_io.open_jsonl(output_file, "wb") as outfile:
+        for line in tqdm(lines, desc="Writing output", total=len(kept)):
+            outfile.write(line if line.endswith(b"\n") else line + b"\n")
 
-    print(f"Total unique records after processing: {len(filtered_records)}")
+    if db is not None:
+        # Only remember this batch once its output is safely written
+        db.commit()
+        db.close()
 
-    # Write the deduplicated records to the output file
-    with open(output_file, "w") as outfile:
-        for record in tqdm(filtered_records, desc="Writing output"):
-            outfile.write(orjson.dumps(record).decode("utf-8") + "\n")
+    instrument.report()
 
 
 if __name__ == "__main__":
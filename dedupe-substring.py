@@ -0,0 +1,290 @@
+import os
+import tempfile
+
+import numpy as np
+import orjson
+from tqdm import tqdm
+
+import instrument
+import jsonl_io
+
+input_file = "filtered_file.jsonl"
+output_file = "substring-deduped.jsonl"
+text_field = "text"
+tokenizer_file = None  # tokenizer.json to work on model tokens, None = UTF-8 bytes
+min_repeat = 100  # A span has to repeat for at least this many tokens to count
+action = "strip"  # "strip" removes repeats after their first occurrence, "flag" only annotates
+max_duplicate_fraction = 0.5  # Records at least this much repeated get "mostly_duplicated" in flag mode
+work_dir = None  # Scratch space (~45 bytes per token), defaults to a temp dir
+memory_limit_mb = 4096  # RAM for the repeat search, larger corpora are sorted bucket by bucket on disk
+encode_batch = 1000
+
+
+def load_tokenizer():
+    if tokenizer_file is None:
+        return None
+    from tokenizers import Tokenizer
+    return Tokenizer.from_file(tokenizer_file)
+
+
+def encode(tokenizer, texts):
+    """
+    Token ids for each text, plus the character offsets of each token when a
+    tokenizer is used (byte tokens map to byte positions directly).
+    """
+    if tokenizer is None:
+        return [np.frombuffer(text.encode("utf-8"), dtype=np.uint8).astype(np.uint32) for text in texts], None
+    encodings = tokenizer.encode_batch(texts, add_special_tokens=False)
+    return [np.array(e.ids, dtype=np.uint32) for e in encodings], [e.offsets for e in encodings]
+
+
+def iter_texts(path):
+    with jsonl_io.open_jsonl(path, "rb") as infile:
+        for line in infile:
+            if not line.strip():
+                continue
+            with instrument.phase("parse"):
+                record = orjson.loads(line)
+            yield record, record.get(text_field) or ""
+
+
+def write_tokens(tokenizer, token_path):
+    """
+    Pass 1: tokenize every record into one flat uint32 file. Each document is
+    followed by its own separator id, so no repeat can span two documents.
+    """
+    vocab = 256 if tokenizer is None else tokenizer.get_vocab_size(with_added_tokens=True)
+    starts = []
+    position = 0
+    with open(token_path, "wb") as outfile:
+        batch = []
+
+        def flush():
+            nonlocal position
+            with instrument.phase("compute"):
+                encoded, _ = encode(tokenizer, batch)
+            for ids in encoded:
+                starts.append(position)
+                outfile.write(ids.tobytes())
+                outfile.write(np.uint32(vocab + len(starts) - 1).tobytes())
+                position += len(ids) + 1
+            batch.clear()
+
+        for _, text in tqdm(iter_texts(input_file), desc="Tokenizing"):
+            batch.append(text)
+            if len(batch) >= encode_batch:
+                flush()
+        if batch:
+            flush()
+
+    if vocab + len(starts) >= 2 ** 32:
+        raise ValueError("Too many documents for uint32 separator ids")
+    return np.array(starts, dtype=np.int64), position
+
+
+# Window fingerprints: two independent 64-bit lanes, so a false match needs
+# a 128-bit collision
+_SEEDS = (np.uint64(0x9E3779B97F4A7C15), np.uint64(0xC2B2AE3D27D4EB4F))
+_RECORD = np.dtype([("hi", "<u8"), ("lo", "<u8"), ("pos", "<i8")])
+
+
+def _mix(x):
+    # splitmix64 finalizer, a bijection on uint64
+    x = x ^ (x >> np.uint64(30))
+    x = x * np.uint64(0xBF58476D1CE4E5B9)
+    x = x ^ (x >> np.uint64(27))
+    x = x * np.uint64(0x94D049BB133111EB)
+    return x ^ (x >> np.uint64(31))
+
+
+def _combine(left, right, lane):
+    return _mix(left * _SEEDS[lane] + right)
+
+
+def spans(n, size):
+    for start in range(0, n, size):
+        yield start, min(start + size, n)
+
+
+def window_hashes(tokens, n, h, path, chunk):
+    """
+    Fingerprint of the length-h window (h a power of two) at every position,
+    built by doubling like a suffix array's prefix ranks: window 2k at i is
+    window k at i combined with window k at i + k. Done in place on a memmap,
+    one chunk at a time; going left to right, a round only reads positions it
+    hasn't overwritten yet.
+    """
+    lanes = np.memmap(path, dtype=np.uint64, mode="w+", shape=(n, 2))
+    for start, end in spans(n, chunk):
+        block = tokens[start:end].astype(np.uint64)
+        for lane in (0, 1):
+            lanes[start:end, lane] = _mix(block + _SEEDS[lane])
+    k = 1
+    while k < h:
+        for start, end in spans(n, chunk):
+            block = np.array(lanes[start:min(end + k, n)])
+            right = np.zeros((end - start, 2), dtype=np.uint64)  # Past the end, never a valid window
+            right[:max(len(block) - k, 0)] = block[k:]
+            for lane in (0, 1):
+                lanes[start:end, lane] = _combine(block[:end - start, lane], right[:, lane], lane)
+        k *= 2
+    lanes.flush()
+    return lanes
+
+
+def partition_windows(lanes, n, h, scratch, chunk, buckets):
+    """
+    Write (fingerprint, position) of every length-min_repeat window into
+    `buckets` files by the top bits of the fingerprint, so each bucket can be
+    sorted on its own. Two overlapping length-h halves cover the window.
+    """
+    bits = buckets.bit_length() - 1
+    paths = [os.path.join(scratch, f"bucket-{b:05d}") for b in range(buckets)]
+    files = [open(path, "wb") for path in paths]
+    try:
+        for start, end in spans(n - min_repeat + 1, chunk):
+            first = np.array(lanes[start:end])
+            second = np.array(lanes[start + min_repeat - h:end + min_repeat - h])
+            records = np.empty(end - start, dtype=_RECORD)
+            records["hi"] = _combine(first[:, 0], second[:, 0], 0)
+            records["lo"] = _combine(first[:, 1], second[:, 1], 1)
+            records["pos"] = np.arange(start, end)
+            bucket = (records["hi"] >> np.uint64(64 - bits)).astype(np.int64) if bits else np.zeros(end - start, int)
+            order = np.argsort(bucket, kind="stable")
+            bounds = np.concatenate(([0], np.cumsum(np.bincount(bucket, minlength=buckets))))
+            records = records[order]
+            for b in np.flatnonzero(np.diff(bounds)):
+                files[b].write(records[bounds[b]:bounds[b + 1]].tobytes())
+    finally:
+        for outfile in files:
+            outfile.close()
+    return paths
+
+
+def repeated_mask(tokens, n, scratch):
+    """
+    Mark every token covered by a span of >= min_repeat tokens that also
+    occurs earlier in the corpus. First occurrences are left alone.
+
+    Equivalent to grouping the suffix array by its first min_repeat tokens,
+    but out of core: window fingerprints are sorted bucket by bucket, so RAM
+    stays around memory_limit_mb however large the corpus is. Scratch space
+    in work_dir is about 40 bytes per token (16 for the fingerprints, 24 for
+    the buckets), plus 8 per duplicated window.
+    """
+    covered = np.memmap(os.path.join(scratch, "covered.u8"), dtype=np.bool_, mode="w+", shape=(n,))
+    windows = n - min_repeat + 1
+    if windows <= 0:
+        return covered
+    budget = memory_limit_mb << 20
+    chunk = max(budget // 128, 1 << 16)  # ~128 bytes of temporaries per token in a chunk
+    # A bucket is sorted in RAM: its records plus lexsort and gather temporaries
+    buckets = 1 << max(int(np.ceil(np.log2(windows * _RECORD.itemsize * 4 / budget))), 0)
+    h = 1 << (min_repeat.bit_length() - 1)
+
+    lanes = window_hashes(tokens, n, h, os.path.join(scratch, "windows.u64"), chunk)
+    bucket_paths = partition_windows(lanes, n, h, scratch, chunk, buckets)
+    del lanes
+    os.remove(os.path.join(scratch, "windows.u64"))
+
+    # Every occurrence after the earliest one of a window is a duplicate; file
+    # them by position range for the coverage pass
+    ranges = [os.path.join(scratch, f"range-{r:05d}") for r in range((n + chunk - 1) // chunk)]
+    range_files = [open(path, "wb") for path in ranges]
+    try:
+        for path in bucket_paths:
+            records = np.fromfile(path, dtype=_RECORD)
+            os.remove(path)
+            records = records[np.lexsort((records["pos"], records["lo"], records["hi"]))]
+            repeat = np.zeros(len(records), dtype=bool)
+            repeat[1:] = (records["hi"][1:] == records["hi"][:-1]) & (records["lo"][1:] == records["lo"][:-1])
+            duplicates = np.sort(records["pos"][repeat])
+            del records, repeat
+            bounds = np.searchsorted(duplicates, np.arange(len(ranges) + 1) * chunk)
+            for r in np.flatnonzero(np.diff(bounds)):
+                range_files[r].write(duplicates[bounds[r]:bounds[r + 1]].tobytes())
+    finally:
+        for outfile in range_files:
+            outfile.close()
+
+    # A token is covered if the last duplicate window starting at or before it
+    # is less than min_repeat tokens back
+    last = -min_repeat
+    for r, (start, end) in enumerate(spans(n, chunk)):
+        duplicates = np.fromfile(ranges[r], dtype=np.int64)
+        os.remove(ranges[r])
+        marker = np.full(end - start, -min_repeat, dtype=np.int64)
+        marker[duplicates - start] = duplicates
+        marker = np.maximum.accumulate(marker)
+        np.maximum(marker, last, out=marker)
+        covered[start:end] = np.arange(start, end) - marker < min_repeat
+        last = int(marker[-1])
+    covered.flush()
+    return covered
+
+
+def strip_text(text, covered, offsets):
+    if offsets is None:
+        data = np.frombuffer(text.encode("utf-8"), dtype=np.uint8)
+        return data[~covered].tobytes().decode("utf-8", errors="ignore")
+    pieces = []
+    cursor = 0
+    for (start, end), drop in zip(offsets, covered):
+        if drop:
+            pieces.append(text[cursor:start])
+            cursor = max(cursor, end)
+    pieces.append(text[cursor:])
+    return "".join(pieces)
+
+
+def main():
+    instrument.start("dedupe-substring")
+    tokenizer = load_tokenizer()
+
+    with tempfile.TemporaryDirectory(dir=work_dir, prefix="substring-") as scratch:
+        token_path = os.path.join(scratch, "tokens.u32")
+        starts, n = write_tokens(tokenizer, token_path)
+        print(f"Tokenized {len(starts)} records into {n} tokens")
+        if n == 0:
+            jsonl_io.open_jsonl(output_file, "wb").close()
+            instrument.report()
+            return
+
+        tokens = np.memmap(token_path, dtype=np.uint32, mode="r", shape=(n,))
+        with instrument.phase("compute"):
+            covered = repeated_mask(tokens, n, scratch)
+            del tokens
+        print(f"{int(covered.sum())} of {n} tokens are in repeated spans of >= {min_repeat}")
+
+        kept = stripped = flagged = 0
+        with jsonl_io.open_jsonl(output_file, "wb") as outfile:
+            for doc, (record, text) in enumerate(tqdm(iter_texts(input_file), desc="Writing", total=len(starts))):
+                length = (starts[doc + 1] - 1 if doc + 1 < len(starts) else n - 1) - starts[doc]
+                mask = covered[starts[doc]:starts[doc] + length]
+                fraction = float(mask.mean()) if length else 0.0
+
+                if action == "flag":
+                    record["duplicate_fraction"] = round(fraction, 4)
+                    record["mostly_duplicated"] = fraction >= max_duplicate_fraction
+                    flagged += record["mostly_duplicated"]
+                elif mask.any():
+                    with instrument.phase("compute"):
+                        _, offsets = encode(tokenizer, [text]) if tokenizer is not None else (None, [None])
+                        record[text_field] = strip_text(text, mask, offsets[0])
+                    stripped += 1
+                    if not record[text_field].strip():
+                        continue  # Nothing left but repeats
+
+                with instrument.phase("write"):
+                    outfile.write(orjson.dumps(record, option=orjson.OPT_APPEND_NEWLINE))
+                kept += 1
+
+    if action == "flag":
+        print(f"Flagged {flagged} of {kept} records as mostly duplicated")
+    else:
+        print(f"Stripped repeats from {stripped} records, kept {kept}")
+    instrument.report()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,222 @@
+"""
+Content fingerprints and a persistent SQLite store of them, so a new scrape
+batch can be deduplicated against everything kept in earlier runs without
+re-running the whole corpus.
+
+Exact duplicates are keyed by a BLAKE2 hash of the content. Near-duplicates
+use MinHash signatures over word shingles, indexed by LSH bands: a new
+signature only gets compared with stored signatures that share a band.
+"""
+import hashlib
+import sqlite3
+import zlib
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# Tuned for dedupe-fuzz's fuzz.ratio >= 85. Such pairs can differ in up to a
+# quarter of their words, which leaves a word-bigram Jaccard of ~0.4-0.85, so
+# the bands have to catch low similarities: 42 bands x 3 rows (126 of the 128
+# values) propose ~100% of pairs up to 18% word edits and ~97% at 25%, while
+# unrelated texts (Jaccard < 0.05) almost never share a band.
+num_perm = 128
+num_bands = 42
+shingle_size = 2  # Words per shingle
+jaccard_threshold = 0.5  # For find_near, which has no text to run fuzz.ratio on
+seed = 1
+
+_MERSENNE = (1 << 61) - 1
+_MAX_HASH = (1 << 32) - 1
+_perms = None
+
+
+def _permutations():
+    global _perms
+    if np is None:
+        raise ImportError("MinHash signatures need numpy (pip install numpy)")
+    if _perms is None:
+        # Fixed seed: signatures have to be comparable across runs
+        rng = np.random.RandomState(seed)
+        _perms = (
+            rng.randint(1, _MERSENNE, size=num_perm, dtype=np.uint64),
+            rng.randint(0, _MERSENNE, size=num_perm, dtype=np.uint64),
+        )
+    return _perms
+
+
+def content_hash(text):
+    return hashlib.blake2b(text.encode("utf-8"), digest_size=16).digest()
+
+
+def shingles(text):
+    words = text.split()
+    if len(words) <= shingle_size:
+        return {zlib.crc32(" ".join(words).encode("utf-8"))}
+    return {
+        zlib.crc32(" ".join(words[i:i + shingle_size]).encode("utf-8"))
+        for i in range(len(words) - shingle_size + 1)
+    }
+
+
+def minhash(text):
+    """
+    MinHash signature of `text` as a uint32 array of length num_perm.
+    """
+    a, b = _permutations()
+    hashes = np.fromiter(shingles(text), dtype=np.uint64)
+    signature = np.full(num_perm, _MAX_HASH, dtype=np.uint64)
+    # Bound the temporary (shingles x num_perm) matrix for long stories
+    for start in range(0, len(hashes), 4096):
+        block = hashes[start:start + 4096, None]
+        permuted = ((block * a + b) % _MERSENNE) & _MAX_HASH
+        np.minimum(signature, permuted.min(axis=0), out=signature)
+    return signature.astype(np.uint32)
+
+
+def band_keys(signature):
+    rows = num_perm // num_bands
+    return [
+        hashlib.blake2b(signature[i * rows:(i + 1) * rows].tobytes(), digest_size=8).digest()
+        for i in range(num_bands)
+    ]
+
+
+def similarity(signature_a, signature_b):
+    """
+    Estimated Jaccard similarity of two signatures.
+    """
+    return float(np.count_nonzero(signature_a == signature_b)) / len(signature_a)
+
+
+class FingerprintDB:
+    """
+    SQLite-backed store of exact hashes and MinHash LSH bands. Changes are
+    only committed by commit(), so an interrupted run leaves the store as it
+    was before the batch.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.conn = sqlite3.connect(path)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript("""
+            CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+            CREATE TABLE IF NOT EXISTS exact (hash BLOB PRIMARY KEY) WITHOUT ROWID;
+            CREATE TABLE IF NOT EXISTS docs (id INTEGER PRIMARY KEY, signature BLOB);
+            CREATE TABLE IF NOT EXISTS bands (
+                band INTEGER, key BLOB, doc INTEGER, PRIMARY KEY (band, key, doc)
+            ) WITHOUT ROWID;
+        """)
+        self._check_settings()
+
+    def _check_settings(self):
+        settings = {"num_perm": num_perm, "num_bands": num_bands, "shingle_size": shingle_size, "seed": seed}
+        stored = dict(self.conn.execute("SELECT key, value FROM meta"))
+        if not stored:
+            self.conn.executemany("INSERT INTO meta VALUES (?, ?)", [(k, str(v)) for k, v in settings.items()])
+            self.conn.commit()
+            return
+        for key, value in settings.items():
+            if stored.get(key) != str(value):
+                raise ValueError(
+                    f"{self.path} was built with {key}={stored.get(key)}, current setting is {value}"
+                )
+
+    def has_exact(self, digest):
+        return self.conn.execute("SELECT 1 FROM exact WHERE hash = ?", (digest,)).fetchone() is not None
+
+    def find_near(self, signature, threshold=None):
+        """
+        Return the id of a stored document at least `threshold` similar to
+        `signature`, or None.
+        """
+        threshold = jaccard_threshold if threshold is None else threshold
+        checked = set()
+        for band, key in enumerate(band_keys(signature)):
+            for (doc,) in self.conn.execute("SELECT doc FROM bands WHERE band = ? AND key = ?", (band, key)):
+                if doc in checked:
+                    continue
+                checked.add(doc)
+                (stored,) = self.conn.execute("SELECT signature FROM docs WHERE id = ?", (doc,)).fetchone()
+                if similarity(signature, np.frombuffer(stored, dtype=np.uint32)) >= threshold:
+                    return doc
+        return None
+
+    def add(self, digest, signature=None):
+        self.conn.execute("INSERT OR IGNORE INTO exact VALUES (?)", (digest,))
+        if signature is None:
+            return None
+        doc = self.conn.execute("INSERT INTO docs (signature) VALUES (?)", (signature.tobytes(),)).lastrowid
+        self.conn.executemany(
+            "INSERT OR IGNORE INTO bands VALUES (?, ?, ?)",
+            [(band, key, doc) for band, key in enumerate(band_keys(signature))],
+        )
+        return doc
+
+    def commit(self):
+        self.conn.commit()
+
+    def close(self):
+        self.conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *exc):
+        if exc_type is None:
+            self.commit()
+        self.close()
+        return False
+
+
+def candidate_pairs(signatures):
+    """
+    All (i, j), i < j, whose signatures share at least one LSH band, as an
+    (n, 2) int64 array sorted row-wise.
+    """
+    rows = num_perm // num_bands
+    pairs = set()
+    for band in range(num_bands):
+        block = np.ascontiguousarray(signatures[:, band * rows:(band + 1) * rows])
+        keys = block.view(np.dtype((np.void, block.dtype.itemsize * rows))).ravel()
+        _, inverse, counts = np.unique(keys, return_inverse=True, return_counts=True)
+        if counts.max(initial=0) < 2:
+            continue
+        order = np.argsort(inverse, kind="stable")
+        bounds = np.cumsum(counts)
+        for group in np.flatnonzero(counts > 1):
+            members = order[bounds[group] - counts[group]:bounds[group]].tolist()
+            for a in range(len(members)):
+                for b in range(a + 1, len(members)):
+                    pairs.add((members[a], members[b]))
+    if not pairs:
+        return np.empty((0, 2), dtype=np.int64)
+    return np.array(sorted(pairs), dtype=np.int64)
+
+
+class UnionFind:
+    def __init__(self, size):
+        self.parent = list(range(size))
+
+    def find(self, x):
+        root = x
+        while self.parent[root] != root:
+            root = self.parent[root]
+        while self.parent[x] != root:
+            self.parent[x], x = root, self.parent[x]
+        return root
+
+    def union(self, a, b):
+        a, b = self.find(a), self.find(b)
+        if a != b:
+            # Lower index becomes the root so the result never depends on call order
+            self.parent[max(a, b)] = min(a, b)
+
+    def clusters(self):
+        groups = {}
+        for x in range(len(self.parent)):
+            groups.setdefault(self.find(x), []).append(x)
+        return groups
@@ -0,0 +1,286 @@
+"""
+Opt-in timing and resource instrumentation shared by the pipeline scripts.
+
+Everything is off unless ORION_PROFILE is set; 0, false, no and off count as
+unset. While it is off, phase() and task() hand back no-op objects and
+nothing else runs. Turn it on with:
+
+    ORION_PROFILE=report.json python dedupe-fuzz.py   (or ORION_PROFILE=1)
+    ORION_PROFILE_CPROFILE=1       also run cProfile in every process
+    ORION_PROFILE_TRACEMALLOC=1    also take tracemalloc snapshots
+    ORION_PROFILE_INTERVAL=0.5     RSS/CPU sampling interval in seconds
+
+Every process (the main one and each Pool worker) writes its own part file
+and report() merges them into one JSON report at the end of the run.
+"""
+import contextlib
+import cProfile
+import glob
+import os
+import pickle
+import pstats
+import shutil
+import tempfile
+import threading
+import time
+import tracemalloc
+
+import orjson
+
+ENV = "ORION_PROFILE"
+enabled = os.environ.get(ENV, "").strip().lower() not in ("", "0", "false", "no", "off")
+
+_NULL = contextlib.nullcontext()
+_state = None
+
+
+class _State:
+    def __init__(self, role):
+        self.role = role
+        self.pid = os.getpid()
+        self.started = time.perf_counter()
+        self.cpu_started = os.times()
+        self.phases = {}  # name -> [seconds, calls]
+        self.counters = {}
+        self.peak_rss = 0
+        self.samples = []  # (seconds since start, rss MB, cpu seconds)
+        self.last_flush = time.monotonic()
+        self.profiler = None
+        self.sampler = None
+        self.stop = threading.Event()
+
+
+class _Phase:
+    __slots__ = ("name", "start")
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+
+    def __exit__(self, *exc):
+        entry = _state.phases.setdefault(self.name, [0.0, 0])
+        entry[0] += time.perf_counter() - self.start
+        entry[1] += 1
+        return False
+
+
+class _Task:
+    """
+    Pool task wrapper: times the call, estimates the cost of pickling the
+    result back to the parent, and flushes the worker's numbers regularly so
+    they survive Pool.terminate().
+    """
+
+    def __init__(self, fn):
+        self.fn = fn
+
+    def __call__(self, *args):
+        _ensure_worker()
+        if _state is None:
+            return self.fn(*args)
+        with _Phase("task"):
+            result = self.fn(*args)
+        with _Phase("ipc"):
+            # The Pool pickles the result again; this only measures the cost
+            payload = pickle.dumps(result, pickle.HIGHEST_PROTOCOL)
+        count("ipc_bytes", len(payload))
+        if time.monotonic() - _state.last_flush > 1.0:
+            flush()
+        return result
+
+
+def phase(name):
+    """
+    Time a block under `name` (parse, compute, ipc, write, ...).
+    """
+    if not enabled:
+        return _NULL
+    _ensure_worker()
+    return _NULL if _state is None else _Phase(name)
+
+
+def count(name, amount=1):
+    if enabled:
+        _ensure_worker()
+        if _state is not None:
+            _state.counters[name] = _state.counters.get(name, 0) + amount
+
+
+def task(fn):
+    """
+    Wrap a function handed to Pool.map/imap/starmap. Returns `fn` itself when
+    instrumentation is off.
+    """
+    return _Task(fn) if enabled else fn
+
+
+def _rss_bytes():
+    try:
+        with open("/proc/self/statm", "rb") as statm:
+            return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def _sample(state):
+    interval = float(os.environ.get("ORION_PROFILE_INTERVAL", "0.5"))
+    while not state.stop.wait(interval):
+        rss = _rss_bytes()
+        state.peak_rss = max(state.peak_rss, rss)
+        times = os.times()
+        state.samples.append((
+            round(time.perf_counter() - state.started, 3),
+            round(rss / (1024 * 1024), 1),
+            round(times.user + times.system, 3),
+        ))
+        if len(state.samples) > 2000:
+            del state.samples[::2]  # Keep long runs bounded
+
+
+def _begin(role):
+    global _state
+    if _state is not None and _state.profiler is not None:
+        _state.profiler.disable()  # Inherited from the parent on fork
+    _state = _State(role)
+    _state.peak_rss = _rss_bytes()
+    _state.sampler = threading.Thread(target=_sample, args=(_state,), daemon=True)
+    _state.sampler.start()
+    if os.environ.get("ORION_PROFILE_CPROFILE"):
+        _state.profiler = cProfile.Profile()
+        _state.profiler.enable()
+    if os.environ.get("ORION_PROFILE_TRACEMALLOC") and not tracemalloc.is_tracing():
+        tracemalloc.start()
+
+
+def _ensure_worker():
+    # Forked workers inherit the parent's state, so compare pids
+    if _state is None or _state.pid != os.getpid():
+        worker_init()
+
+
+def start(stage):
+    """
+    Call once at the top of a script's main().
+    """
+    if not enabled:
+        return
+    target = os.environ[ENV]
+    if target.strip().lower() in ("1", "true", "yes", "on"):
+        target = f"{stage}-profile.json"
+    os.environ["ORION_PROFILE_REPORT"] = os.path.abspath(target)
+    os.environ["ORION_PROFILE_STAGE"] = stage
+    os.environ["ORION_PROFILE_DIR"] = tempfile.mkdtemp(prefix=f"{stage}-profile-")
+    _begin("main")
+
+
+def worker_init():
+    """
+    Pool initializer (or call it from an existing one).
+    """
+    if not enabled or "ORION_PROFILE_DIR" not in os.environ:
+        return
+    _begin("worker")
+    from multiprocessing import util
+    # Runs when the worker exits cleanly, i.e. after pool.close(); pool.join()
+    util.Finalize(None, flush, exitpriority=10)
+
+
+def flush():
+    """
+    Write this process's numbers to its part file in the run directory.
+    """
+    if not enabled or _state is None:
+        return
+    state = _state
+    directory = os.environ["ORION_PROFILE_DIR"]
+    times = os.times()
+    part = {
+        "pid": state.pid,
+        "role": state.role,
+        "wall_seconds": time.perf_counter() - state.started,
+        "cpu_user_seconds": times.user - state.cpu_started.user,
+        "cpu_system_seconds": times.system - state.cpu_started.system,
+        "peak_rss_mb": max(state.peak_rss, _rss_bytes()) / (1024 * 1024),
+        "phases": {name: {"seconds": s, "calls": c} for name, (s, c) in state.phases.items()},
+        "counters": state.counters,
+        "samples": state.samples,
+    }
+    if state.profiler is not None:
+        state.profiler.create_stats()
+        state.profiler.dump_stats(os.path.join(directory, f"{state.pid}.prof"))
+        state.profiler.enable()
+    if tracemalloc.is_tracing():
+        snapshot = tracemalloc.take_snapshot()
+        part["tracemalloc_top"] = [
+            {"where": str(stat.traceback), "size_mb": stat.size / (1024 * 1024), "count": stat.count}
+            for stat in snapshot.statistics("lineno")[:25]
+        ]
+
+    path = os.path.join(directory, f"{state.pid}.json")
+    with open(path + ".tmp", "wb") as outfile:
+        outfile.write(orjson.dumps(part))
+    os.replace(path + ".tmp", path)
+    state.last_flush = time.monotonic()
+
+
+def report():
+    """
+    Merge every part file of the run into a single report. Call at the end of
+    main(), after the Pool has been closed and joined.
+    """
+    if not enabled or _state is None or _state.role != "main":
+        return None
+    _state.stop.set()
+    flush()
+
+    directory = os.environ["ORION_PROFILE_DIR"]
+    parts = []
+    for path in sorted(glob.glob(os.path.join(directory, "*.json"))):
+        with open(path, "rb") as infile:
+            parts.append(orjson.loads(infile.read()))
+
+    totals = {}
+    for part in parts:
+        for name, entry in part["phases"].items():
+            total = totals.setdefault(name, {"seconds": 0.0, "calls": 0})
+            total["seconds"] += entry["seconds"]
+            total["calls"] += entry["calls"]
+
+    merged = {
+        "stage": os.environ["ORION_PROFILE_STAGE"],
+        "wall_seconds": time.perf_counter() - _state.started,
+        "processes": len(parts),
+        "peak_rss_mb": {
+            "main": max((p["peak_rss_mb"] for p in parts if p["role"] == "main"), default=0),
+            "worker": max((p["peak_rss_mb"] for p in parts if p["role"] == "worker"), default=0),
+            "sum": sum(p["peak_rss_mb"] for p in parts),
+        },
+        "cpu_seconds": sum(p["cpu_user_seconds"] + p["cpu_system_seconds"] for p in parts),
+        "phases": totals,
+        "counters": {},
+        "workers": parts,
+    }
+    for part in parts:
+        for name, value in part["counters"].items():
+            merged["counters"][name] = merged["counters"].get(name, 0) + value
+
+    target = os.environ["ORION_PROFILE_REPORT"]
+    profiles = glob.glob(os.path.join(directory, "*.prof"))
+    if profiles:
+        stats = pstats.Stats(*profiles)
+        stats.dump_stats(os.path.splitext(target)[0] + ".prof")
+        stats.sort_stats("cumulative")
+        merged["cprofile_top"] = [
+            {"function": f"{file}:{line}({func})", "calls": nc, "tottime": tt, "cumtime": ct}
+            for (file, line, func), (_, nc, tt, ct, _) in sorted(
+                stats.stats.items(), key=lambda item: item[1][3], reverse=True)[:30]
+        ]
+
+    with open(target, "wb") as outfile:
+        outfile.write(orjson.dumps(merged, option=orjson.OPT_INDENT_2))
+    shutil.rmtree(directory, ignore_errors=True)
+    print(f"Profile report written to {target}")
+    return merged
@@ -0,0 +1,272 @@
+"""
+Transparent plain / .gz / .zst JSONL reading and writing for the pipeline.
+
+open_jsonl() picks the codec from the file extension. .zst files are written
+in the zstd seekable format: independent frames that always end on a line
+boundary, followed by a seek table in a skippable frame. Any zstd decoder
+still reads them as a normal stream, and split_ranges()/read_range() use the
+seek table so Pool workers can each decompress their own run of frames.
+"""
+import collections
+import contextlib
+import gzip
+import io
+import os
+import shutil
+import struct
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    from isal import igzip_threaded
+except ImportError:
+    igzip_threaded = None
+
+threads = os.cpu_count() or 1
+zstd_level = 3
+gzip_level = 6
+frame_size = 4 * 1024 * 1024  # Uncompressed bytes per seekable zstd frame
+scratch_dir = os.environ.get("ORION_SCRATCH") or None  # Where plain_copy() decompresses, None: next to the input
+
+_SKIPPABLE_MAGIC = 0x184D2A5E
+_SEEKABLE_MAGIC = 0x8F92EAB1
+
+
+def codec(path):
+    if path.endswith(".zst"):
+        return "zst"
+    if path.endswith(".gz"):
+        return "gz"
+    return None
+
+
+def _require_zstd():
+    if zstandard is None:
+        raise ImportError("Reading or writing .zst files needs the zstandard package (pip install zstandard)")
+
+
+class SeekableZstdWriter(io.RawIOBase):
+    """
+    Buffers writes, cuts them into line-aligned frames, compresses the frames
+    on a thread pool (zstandard releases the GIL) and appends the seek table
+    on close.
+    """
+
+    def __init__(self, path, level=None, workers=None):
+        _require_zstd()
+        self._file = open(path, "wb")
+        self._level = zstd_level if level is None else level
+        self._workers = max(1, threads if workers is None else workers)
+        self._pool = ThreadPoolExecutor(self._workers)
+        self._local = threading.local()
+        self._pending = collections.deque()
+        self._buffer = bytearray()
+        self._entries = []  # (compressed size, decompressed size)
+
+    def writable(self):
+        return True
+
+    def _compress(self, chunk):
+        compressor = getattr(self._local, "compressor", None)
+        if compressor is None:
+            compressor = self._local.compressor = zstandard.ZstdCompressor(level=self._level)
+        return compressor.compress(chunk), len(chunk)
+
+    def _drain(self, keep):
+        while len(self._pending) > keep:
+            frame, size = self._pending.popleft().result()
+            self._file.write(frame)
+            self._entries.append((len(frame), size))
+
+    def _submit(self, chunk):
+        self._pending.append(self._pool.submit(self._compress, bytes(chunk)))
+        self._drain(self._workers * 2)
+
+    def write(self, data):
+        self._buffer += data
+        while len(self._buffer) >= frame_size:
+            cut = self._buffer.rfind(b"\n", 0, frame_size)
+            if cut < 0:
+                cut = self._buffer.find(b"\n", frame_size)
+            if cut < 0:
+                break  # One huge line, wait for its end
+            cut += 1
+            self._submit(self._buffer[:cut])
+            del self._buffer[:cut]
+        return len(data)
+
+    def close(self):
+        if self.closed:
+            return
+        try:
+            if self._buffer:
+                self._submit(self._buffer)
+                self._buffer = bytearray()
+            self._drain(0)
+            self._pool.shutdown()
+            table = b"".join(struct.pack("<II", c, d) for c, d in self._entries)
+            footer = struct.pack("<IBI", len(self._entries), 0, _SEEKABLE_MAGIC)
+            self._file.write(struct.pack("<II", _SKIPPABLE_MAGIC, len(table) + len(footer)))
+            self._file.write(table + footer)
+        finally:
+            self._file.close()
+            super().close()
+
+
+def read_seek_table(path):
+    """
+    Return [(compressed offset, compressed size, decompressed size)] for a
+    seekable .zst file, or None if it has no seek table.
+    """
+    with open(path, "rb") as infile:
+        infile.seek(0, os.SEEK_END)
+        size = infile.tell()
+        if size < 17:
+            return None
+        infile.seek(size - 9)
+        count, descriptor, magic = struct.unpack("<IBI", infile.read(9))
+        if magic != _SEEKABLE_MAGIC:
+            return None
+        entry_size = 12 if descriptor & 0x80 else 8
+        table_start = size - 9 - count * entry_size
+        infile.seek(table_start - 8)
+        skippable, _ = struct.unpack("<II", infile.read(8))
+        if skippable != _SKIPPABLE_MAGIC:
+            return None
+        table = infile.read(count * entry_size)
+
+    frames = []
+    offset = 0
+    for i in range(count):
+        compressed, decompressed = struct.unpack_from("<II", table, i * entry_size)
+        frames.append((offset, compressed, decompressed))
+        offset += compressed
+    return frames
+
+
+def open_jsonl(path, mode="r"):
+    """
+    open() for JSONL files. `mode` is one of r, w, rb, wb; text modes are UTF-8.
+    """
+    binary = "b" in mode
+    writing = "w" in mode
+    kind = codec(path)
+
+    if kind == "zst":
+        if writing:
+            stream = io.BufferedWriter(SeekableZstdWriter(path), buffer_size=1024 * 1024)
+        else:
+            _require_zstd()
+            reader = zstandard.ZstdDecompressor().stream_reader(open(path, "rb"), read_across_frames=True)
+            stream = io.BufferedReader(reader, buffer_size=1024 * 1024)
+    elif kind == "gz":
+        raw_mode = "wb" if writing else "rb"
+        if igzip_threaded is not None:
+            stream = igzip_threaded.open(path, raw_mode, compresslevel=min(gzip_level, 3), threads=threads)
+        else:
+            stream = gzip.open(path, raw_mode, compresslevel=gzip_level)
+    else:
+        return open(path, mode) if binary else open(path, mode, encoding="utf-8")
+
+    if binary:
+        return stream
+    return io.TextIOWrapper(stream, encoding="utf-8")
+
+
+def splittable(path):
+    kind = codec(path)
+    return kind is None or (kind == "zst" and read_seek_table(path) is not None)
+
+
+def split_ranges(path, parts):
+    """
+    Split a file into at most `parts` (start, end) ranges of whole lines that
+    read_range() can process independently. Offsets are in the file itself,
+    i.e. compressed bytes for .zst, where ranges follow frame boundaries.
+    """
+    if codec(path) == "zst":
+        frames = read_seek_table(path)
+        if frames is None:
+            raise ValueError(f"{path} has no zstd seek table, it can't be split")
+        if not frames:
+            return []
+        total = sum(size for _, size, _ in frames)
+        step = max(1, total // parts)
+        bounds = [0]
+        for offset, size, _ in frames[1:]:
+            if offset - bounds[-1] >= step and len(bounds) < parts:
+                bounds.append(offset)
+        bounds.append(frames[-1][0] + frames[-1][1])
+        return list(zip(bounds[:-1], bounds[1:]))
+    if codec(path) is not None:
+        raise ValueError(f"{path} is not splittable, only plain and seekable .zst files are")
+
+    size = os.path.getsize(path)
+    step = max(1, size // parts)
+    bounds = [0]
+    with open(path, "rb") as infile:
+        for i in range(1, parts):
+            pos = i * step
+            if pos <= bounds[-1]:
+                continue
+            infile.seek(pos)
+            infile.readline()  # Move to the start of the next line
+            pos = infile.tell()
+            if pos >= size:
+                break
+            bounds.append(pos)
+    bounds.append(size)
+    return list(zip(bounds[:-1], bounds[1:]))
+
+
+def read_range(path, start, end):
+    """
+    Yield the lines (as bytes) of a range returned by split_ranges().
+    """
+    if codec(path) == "zst":
+        _require_zstd()
+        decompressor = zstandard.ZstdDecompressor()
+        with open(path, "rb") as infile:
+            for offset, compressed, decompressed in read_seek_table(path):
+                if offset < start or offset >= end:
+                    continue
+                # Frames end on line boundaries, so each one holds whole lines
+                infile.seek(offset)
+                data = decompressor.decompress(infile.read(compressed), max_output_size=decompressed)
+                yield from io.BytesIO(data)
+        return
+
+    with open(path, "rb") as infile:
+        infile.seek(start)
+        pos = start
+        while pos < end:
+            line = infile.readline()
+            if not line:
+                break
+            pos += len(line)
+            yield line
+
+
+@contextlib.contextmanager
+def plain_copy(path):
+    """
+    Yield a path to an uncompressed version of `path` for stages that need
+    random access (mmap). Compressed inputs are decompressed to a temporary
+    file in scratch_dir (next to the input by default), removed afterwards.
+    """
+    if codec(path) is None:
+        yield path
+        return
+    fd, tmp_path = tempfile.mkstemp(suffix=".jsonl", dir=scratch_dir or os.path.dirname(os.path.abspath(path)))
+    try:
+        with os.fdopen(fd, "wb") as outfile, open_jsonl(path, "rb") as infile:
+            shutil.copyfileobj(infile, outfile, 16 * 1024 * 1024)
+        yield tmp_path
+    finally:
+        os.remove(tmp_path)
@@ -3,14 +3,21 @@ import json
 from tqdm import tqdm
 from multiprocessing import Pool
 
+import instrument
+import jsonl_io
+
 input_file = "ass-pruned.jsonl"
 output_file = "filtered-ass.jsonl"
+num_workers = 8  # Use 8 workers, happy now?
 
 def process_line(line):
     try:
-        record = json.loads(line)
+        with instrument.phase("parse"):
+            record = json.loads(line)
         text = record.get("content", "")
-        if detect(text) == "en":  # Keep only English
+        with instrument.phase("compute"):
+            lang = detect(text)
+        if lang == "en":  # Keep only English
             return json.dumps(record)
     except Exception:
         # If detection fails, skip the line
@@ -18,22 +25,25 @@ def process_line(line):
 
 
 def main():
-    with open(input_file, "r") as infile:
+    instrument.start("lang-filter")
+    with instrument.phase("read"), jsonl_io.open_jsonl(input_file, "r") as infile:
         lines = infile.readlines()
 
-    # Use 8 workers, happy now?
-    num_workers = 8
-    with Pool(num_workers) as pool:
+    with Pool(num_workers, initializer=instrument.worker_init) as pool:
         results = list(
-            tqdm(pool.imap(process_line, lines), desc="Filtering entries", total=len(lines))
+            tqdm(pool.imap(instrument.task(process_line), lines), desc="Filtering entries", total=len(lines))
         )
+        pool.close()
+        pool.join()
 
     # Write the filtered results back
-    with open(output_file, "w") as outfile:
+    with instrument.phase("write"), jsonl_io.open_jsonl(output_file, "w") as outfile:
         for result in results:
             if result:  # Only write non-skipped lines
                 outfile.write(result + "\n")
 
+    instrument.report()
+
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -0,0 +1,171 @@
+"""
+Small CPU quality model trained on the ratings ContentRater already produced.
+
+Texts are turned into hashed word unigram/bigram features (log-scaled counts,
+L2-normalized) and a logistic regression in plain NumPy predicts whether the
+LLM would rate a record as good. It is only used for triage: the LLM still
+rates everything the model is not confident about.
+"""
+import re
+import zlib
+
+import numpy as np
+
+num_features = 1 << 18
+good_rating = 4  # Same cut-off Extract.py keeps
+
+_WORD = re.compile(r"\w+")
+
+
+def rating_value(evaluation):
+    """
+    The integer rating of an "evaluation" field (int or {"rating": ...}), or None.
+    """
+    if isinstance(evaluation, dict):
+        evaluation = evaluation.get("rating")
+    return evaluation if isinstance(evaluation, int) and not isinstance(evaluation, bool) else None
+
+
+def featurize(texts):
+    """
+    CSR matrix (indptr, indices, values) of hashed features for `texts`.
+    """
+    indptr = [0]
+    indices = []
+    values = []
+    mask = num_features - 1
+    for text in texts:
+        words = _WORD.findall(text.lower())
+        grams = words + [a + " " + b for a, b in zip(words, words[1:])]
+        if grams:
+            hashed = np.fromiter((zlib.crc32(g.encode("utf-8")) & mask for g in grams), dtype=np.int64, count=len(grams))
+            ids, counts = np.unique(hashed, return_counts=True)
+            weights = 1.0 + np.log(counts)
+            weights /= np.sqrt(np.dot(weights, weights))
+            indices.append(ids)
+            values.append(weights)
+        indptr.append(indptr[-1] + (len(indices[-1]) if grams else 0))
+    if indices:
+        return np.array(indptr), np.concatenate(indices), np.concatenate(values)
+    return np.array(indptr), np.zeros(0, dtype=np.int64), np.zeros(0)
+
+
+def auc(labels, scores):
+    """
+    Area under the ROC curve (Mann-Whitney U, ties get average ranks).
+    """
+    labels = np.asarray(labels, dtype=bool)
+    _, inverse, counts = np.unique(scores, return_inverse=True, return_counts=True)
+    ranks = (np.cumsum(counts) - (counts - 1) / 2)[inverse]
+    positive = labels.sum()
+    negative = len(labels) - positive
+    return float((ranks[labels].sum() - positive * (positive + 1) / 2) / (positive * negative))
+
+
+def evaluate_proxy(probabilities, labels, reject_below, accept_above=None):
+    """
+    How a model would have triaged held-out ratings: its AUC, the share of
+    good records the reject threshold drops and, with an accept threshold,
+    the share of accepted records that really are good.
+    """
+    labels = np.asarray(labels, dtype=bool)
+    rejected = probabilities < reject_below
+    result = {
+        "auc": round(auc(labels, probabilities), 4),
+        "good_rejected": round(float(rejected[labels].mean()), 4),
+        "rejected": round(float(rejected.mean()), 4),
+    }
+    if accept_above is not None:
+        accepted = probabilities > accept_above
+        result["accepted"] = round(float(accepted.mean()), 4)
+        result["accept_precision"] = round(float(labels[accepted].mean()), 4) if accepted.any() else None
+    return result
+
+
+class ProxyRater:
+    def __init__(self, epochs=8, batch=256, learning_rate=0.5, l2=1e-6, seed=0):
+        self.epochs = epochs
+        self.batch = batch
+        self.learning_rate = learning_rate
+        self.l2 = l2
+        self.seed = seed
+        self.weights = np.zeros(num_features)
+        self.bias = 0.0
+        self.source = ""
+        self.evaluation = ""  # Held-out metrics (JSON) from when it was trained
+
+    @staticmethod
+    def _rows(indptr):
+        return np.repeat(np.arange(len(indptr) - 1), np.diff(indptr))
+
+    def _scores(self, indptr, indices, values):
+        rows = self._rows(indptr)
+        return np.bincount(rows, weights=values * self.weights[indices], minlength=len(indptr) - 1) + self.bias
+
+    def fit(self, texts, labels):
+        """
+        Mini-batch AdaGrad on the log loss, with classes weighted to balance
+        and the bias moved back to the real share of good records afterwards.
+        """
+        indptr, indices, values = featurize(texts)
+        labels = np.asarray(labels, dtype=np.float64)
+        positive = labels.mean()
+        sample_weight = np.where(labels > 0, 0.5 / max(positive, 1e-6), 0.5 / max(1 - positive, 1e-6))
+
+        squared = np.full(num_features, 1e-8)
+        squared_bias = 1e-8
+        rng = np.random.default_rng(self.seed)
+        n = len(labels)
+        for _ in range(self.epochs):
+            order = rng.permutation(n)
+            for start in range(0, n, self.batch):
+                rows = np.sort(order[start:start + self.batch])
+                # Slice the CSR rows of this mini-batch
+                lo, hi = indptr[rows], indptr[rows + 1]
+                take = np.concatenate([np.arange(a, b) for a, b in zip(lo, hi)]) if len(rows) else np.zeros(0, int)
+                sub_indptr = np.concatenate(([0], np.cumsum(hi - lo)))
+                sub_indices, sub_values = indices[take], values[take]
+
+                scores = self._scores(sub_indptr, sub_indices, sub_values)
+                residual = (1 / (1 + np.exp(-scores)) - labels[rows]) * sample_weight[rows] / len(rows)
+                grad = np.bincount(
+                    sub_indices, weights=sub_values * residual[self._rows(sub_indptr)], minlength=num_features
+                )
+                touched = np.unique(sub_indices)
+                grad[touched] += self.l2 * self.weights[touched]
+                squared[touched] += grad[touched] ** 2
+                self.weights[touched] -= self.learning_rate * grad[touched] / np.sqrt(squared[touched])
+                grad_bias = residual.sum()
+                squared_bias += grad_bias ** 2
+                self.bias -= self.learning_rate * grad_bias / np.sqrt(squared_bias)
+        # Balancing the classes trains as if half the records were good; shift
+        # the bias back to the real prior so predict_proba is a probability
+        positive = min(max(positive, 1e-6), 1 - 1e-6)
+        self.bias += np.log(positive / (1 - positive))
+        return self
+
+    def predict_proba(self, texts):
+        """
+        Probability that the LLM would rate each text >= good_rating.
+        """
+        if not len(texts):
+            return np.zeros(0)
+        return 1 / (1 + np.exp(-self._scores(*featurize(texts))))
+
+    def save(self, path, source=""):
+        """
+        Write the weights to `path` (npz, the name is kept as given). `source`
+        describes what the model was trained on, so a stale cache can be told apart.
+        """
+        with open(path, "wb") as outfile:
+            np.savez_compressed(outfile, weights=self.weights, bias=self.bias, source=source,
+                                evaluation=self.evaluation)
+
+    @classmethod
+    def load(cls, path):
+        model = cls()
+        data = np.load(path)
+        model.weights, model.bias = data["weights"], float(data["bias"])
+        model.source = str(data["source"]) if "source" in data else ""
+        model.evaluation = str(data["evaluation"]) if "evaluation" in data else ""
+        return model
@@ -1,10 +1,81 @@
-import json
+import os
+import shutil
+import orjson
+from multiprocessing import Pool
+
+import instrument
+import jsonl_io
 
 input_file = "ass.jsonl"
 output_file = "ass-pruned.jsonl"
+fields = ("id", "title", "content")  # Projection set, change for other scrapes
+num_workers = os.cpu_count() or 1  # 1 = old single-core behaviour
+
+
+def prune_line(line, projection):
+    record = orjson.loads(line)
+    if projection.issuperset(record):
+        # Nothing to drop, keep the original bytes as-is
+        return line if line.endswith(b"\n") else line + b"\n"
+    pruned_record = {key: record[key] for key in fields if key in record}
+    return orjson.dumps(pruned_record, option=orjson.OPT_APPEND_NEWLINE)
+
+
+def prune_lines(lines, outfile):
+    projection = frozenset(fields)
+    kept = 0
+    for line in lines:
+        if not line.strip():
+            continue
+        with instrument.phase("parse"):
+            pruned = prune_line(line, projection)
+        with instrument.phase("write"):
+            outfile.write(pruned)
+        kept += 1
+    return kept
+
+
+def prune_range(args):
+    """
+    Prune one byte range of the input into an uncompressed binary shard.
+    """
+    part_id, start, end = args
+    shard_file = f"{output_file}.part{part_id:05d}"
+    with open(shard_file, "wb") as outfile:
+        kept = prune_lines(jsonl_io.read_range(input_file, start, end), outfile)
+    return shard_file, kept
+
+
+def main():
+    instrument.start("prune")
+    if num_workers <= 1 or not jsonl_io.splittable(input_file):
+        # .gz and zstd without a seek table can only be streamed
+        with jsonl_io.open_jsonl(input_file, "rb") as infile, jsonl_io.open_jsonl(output_file, "wb") as outfile:
+            kept = prune_lines(infile, outfile)
+        print(f"Pruned {kept} records")
+        instrument.report()
+        return
+
+    ranges = jsonl_io.split_ranges(input_file, num_workers)
+    print(f"Split {input_file} into {len(ranges)} byte ranges")
+
+    with Pool(num_workers, initializer=instrument.worker_init) as pool:
+        results = pool.map(
+            instrument.task(prune_range), [(i, start, end) for i, (start, end) in enumerate(ranges)]
+        )
+        pool.close()
+        pool.join()
+
+    # Stitch the shards back together in input order, compressing if asked to
+    with instrument.phase("write"), jsonl_io.open_jsonl(output_file, "wb") as outfile:
+        for shard_file, _ in results:
+            with open(shard_file, "rb") as shard:
+                shutil.copyfileobj(shard, outfile, 16 * 1024 * 1024)
+            os.remove(shard_file)
+
+    print(f"Pruned {sum(kept for _, kept in results)} records")
+    instrument.report()
+
 
-with open(input_file, "r") as infile, open(output_file, "w") as outfile:
-    for line in infile:
-        record = json.loads(line)
-        pruned_record = {key: record[key] for key in ("id", "title", "content") if key in record}
-        outfile.write(json.dumps(pruned_record) + "\n")
\ No newline at end of file
+if __name__ == "__main__":
+    main()
@@ -1,5 +1,9 @@
 import asyncio
 import aiohttp
+import itertools
+import math
+import numpy as np
+import os
 import orjson
 import re
 import logging
@@ -8,9 +12,129 @@ from statistics import mode
 from typing import List, Dict, Optional
 from logging.handlers import RotatingFileHandler
 
+import instrument
+import jsonl_io
+from proxy_model import ProxyRater, evaluate_proxy, good_rating, rating_value
+
+# Cheap text statistics beyond which a record is junk and never sent to the LLM
+PREFILTER_THRESHOLDS = {
+    "min_chars": 200,
+    "max_symbol_ratio": 0.3,
+    "min_whitespace_ratio": 0.05,  # Walls of text without spaces (base64, URLs, minified junk)
+    "max_whitespace_ratio": 0.5,
+    "max_repeated_line_ratio": 0.5,
+    "max_mojibake_ratio": 0.01,
+}
+
+_WHITESPACE = np.array([9, 10, 11, 12, 13, 32, 0xA0, 0x3000], dtype=np.uint32)
+# Prose punctuation, including curly quotes and dashes, is not "symbol junk"
+_PUNCTUATION = np.array([ord(c) for c in ".,;:!?'\"()-\u2018\u2019\u201c\u201d\u2013\u2014\u2026\u00ab\u00bb\u00bf\u00a1"],
+                        dtype=np.uint32)
+
+
+def text_stats(texts: List[str]) -> Dict[str, np.ndarray]:
+    """
+    Per-text statistics for a whole batch at once: the batch is decoded into
+    one code point array and counted with cumulative sums per text.
+    """
+    lengths = np.fromiter((len(t) for t in texts), dtype=np.int64, count=len(texts))
+    ends = np.cumsum(lengths)
+    starts = ends - lengths
+    cps = np.frombuffer("".join(texts).encode("utf-32-le"), dtype=np.uint32)
+
+    def per_text(mask):
+        csum = np.concatenate(([0], np.cumsum(mask, dtype=np.int64)))
+        return csum[ends] - csum[starts]
+
+    whitespace = np.isin(cps, _WHITESPACE)
+    wordish = (
+        ((cps >= 48) & (cps <= 57)) | ((cps >= 65) & (cps <= 90)) | ((cps >= 97) & (cps <= 122))
+        | ((cps >= 0xC0) & ~((cps >= 0x2000) & (cps <= 0x2BFF)) & (cps != 0xFFFD) & (cps != 0x3000))
+    )
+    punctuation = np.isin(cps, _PUNCTUATION)
+    following = np.concatenate((cps[1:], [0])).astype(np.uint32)
+    mojibake = (
+        (cps == 0xFFFD)
+        | (((cps == 0xC3) | (cps == 0xC2)) & (following >= 0x80) & (following <= 0xBF))
+        | ((cps == 0xE2) & (following == 0x20AC))  # "â€" from a UTF-8 quote read as cp1252
+    )
+
+    safe = np.maximum(lengths, 1)
+    repeated = np.empty(len(texts))
+    for i, text in enumerate(texts):
+        lines = [line.strip() for line in text.splitlines() if line.strip()]
+        repeated[i] = 1 - len(set(lines)) / len(lines) if lines else 0.0
+
+    return {
+        "chars": lengths,
+        "symbol_ratio": per_text(~(whitespace | wordish | punctuation)) / safe,
+        "whitespace_ratio": per_text(whitespace) / safe,
+        "repeated_line_ratio": repeated,
+        "mojibake_ratio": per_text(mojibake) / safe,
+    }
+
+
+def prefilter_reasons(texts: List[str], thresholds: Dict[str, float]) -> List[Optional[str]]:
+    """
+    Name of the first failed check for each text, or None if it looks plausible.
+    """
+    if not texts:
+        return []
+    stats = text_stats(texts)
+    checks = [
+        ("too_short", stats["chars"] < thresholds["min_chars"]),
+        ("mojibake", stats["mojibake_ratio"] > thresholds["max_mojibake_ratio"]),
+        ("repeated_lines", stats["repeated_line_ratio"] > thresholds["max_repeated_line_ratio"]),
+        ("symbols", stats["symbol_ratio"] > thresholds["max_symbol_ratio"]),
+        ("no_whitespace", stats["whitespace_ratio"] < thresholds["min_whitespace_ratio"]),
+        ("whitespace", stats["whitespace_ratio"] > thresholds["max_whitespace_ratio"]),
+    ]
+    reasons = [None] * len(texts)
+    for name, failed in reversed(checks):
+        for i in np.flatnonzero(failed):
+            reasons[i] = name
+    return reasons
+
+
+def split_windows(text: str, count: int) -> List[str]:
+    """
+    Split `text` into `count` windows of about equal length. Each boundary
+    sits at its fixed target, moved back to whitespace when there is some
+    within a tenth of a window.
+    """
+    size = len(text) / count
+    bounds = [0]
+    for i in range(1, count):
+        target = int(i * size)
+        cut = text.rfind(" ", max(bounds[-1] + 1, target - int(size / 10)), target)
+        bounds.append(cut + 1 if cut != -1 else target)
+    bounds.append(len(text))
+    return [text[start:end] for start, end in zip(bounds, bounds[1:]) if end > start]
+
+
+def round_half_up(value):
+    # Not round(): banker's rounding would send 2.5 to 2 but 3.5 to 4
+    return math.floor(value + 0.5)
+
+
+# Halves round up, so windows scoring 2 and 3 give 3 with "mean" and "median"
+WINDOW_AGGREGATES = {
+    "mean": lambda scores: round_half_up(float(np.mean(scores))),
+    "min": min,
+    "median": lambda scores: round_half_up(float(np.median(scores))),
+}
+
+
 class ContentRater:
     def __init__(self, input_file: str, output_file: str, batch_size: int = 2, api_key: Optional[str] = None,
-                 endpoint_url: str = ""):
+                 endpoint_url: str = "", prefilter: bool = True,
+                 prefilter_thresholds: Optional[Dict[str, float]] = None, prefilter_score: int = 1,
+                 proxy_train_files: Optional[List[str]] = None, proxy_reject_below: float = 0.1,
+                 proxy_accept_above: Optional[float] = None, proxy_accept_score: int = good_rating,
+                 proxy_model_file: Optional[str] = None, confirm: bool = True, schedule: str = "file",
+                 context_window: Optional[int] = None,
+                 overflow: str = "truncate", token_count_field: str = "token_count", chars_per_token: float = 4.0,
+                 window_tokens: Optional[int] = None, window_aggregate: str = "mean"):
         self.logger = logging.getLogger('ContentRater')
         self.logger.setLevel(logging.DEBUG)
 
@@ -42,6 +166,56 @@ class ContentRater:
         self.max_retries = 5
         self.retry_delay = 2
         self.timeout = 600000
+        self.max_tokens = 150
+
+        self.prefilter = prefilter
+        self.prefilter_thresholds = {**PREFILTER_THRESHOLDS, **(prefilter_thresholds or {})}
+        self.prefilter_score = prefilter_score
+        self.prefilter_batch = 1000
+
+        # Proxy triage: a local model trained on earlier LLM ratings decides
+        # which records are clearly bad (or clearly good) without a call
+        self.proxy_train_files = proxy_train_files or []
+        self.proxy_reject_below = proxy_reject_below
+        self.proxy_accept_above = proxy_accept_above
+        self.proxy_accept_score = proxy_accept_score
+        self.proxy_min_train = 200
+        # Part of the LLM ratings is held out to check the model before it settles anything
+        self.proxy_holdout = 0.2
+        self.proxy_min_auc = 0.8
+        self.proxy_max_good_loss = 0.05  # Share of good records the reject threshold may throw away
+        # Trained model cache, reused while the training files are unchanged
+        self.proxy_model_file = proxy_model_file
+
+        # Ask before rating everything after the test records; off for unattended shard runs
+        self.confirm = confirm
+
+        # Length-aware scheduling: "file" keeps input order, "longest_first" sorts by
+        # estimated prompt size, "buckets" never mixes sizes within a batch
+        if schedule not in ("file", "longest_first", "buckets"):
+            raise ValueError(f"Unknown schedule: {schedule}")
+        if overflow not in ("truncate", "skip"):
+            raise ValueError(f"Unknown overflow handling: {overflow}")
+        self.schedule = schedule
+        # Once the proxy has ordered records by priority, sizes are only sorted
+        # within windows of this many batches, so priority still comes first
+        self.schedule_window = 10
+        self.priority_ordered = False
+        self.context_window = context_window
+        self.overflow = overflow
+        self.token_count_field = token_count_field  # Written by tokenizing.py, if enabled there
+        self.chars_per_token = chars_per_token  # Fallback estimate when a record has no token count
+        template = self.build_chat_messages("")
+        self.prompt_overhead = math.ceil(sum(len(m["content"]) for m in template) / chars_per_token) + 16
+
+        # Windowed scoring: documents longer than window_tokens are rated as
+        # several concurrent requests and the window scores aggregated
+        if window_aggregate not in WINDOW_AGGREGATES:
+            raise ValueError(f"Unknown window aggregate: {window_aggregate}")
+        if window_tokens is not None and context_window is not None and window_tokens > self.text_budget():
+            raise ValueError(f"window_tokens={window_tokens} doesn't fit context_window={context_window}")
+        self.window_tokens = window_tokens
+        self.window_aggregate = window_aggregate
 
         self.logger.info(f"Initialized with endpoint: {endpoint_url}")
         self.logger.info(f"Headers: {self.headers}")
@@ -76,14 +250,15 @@ OUTPUT FORMAT:
             }
         ]
 
-    async def get_score_with_retries(self, text: str, session: aiohttp.ClientSession) -> Optional[int]:
+    async def get_score_with_retries(self, text: str, session: aiohttp.ClientSession,
+                                     fallback: Optional[int] = 1) -> Optional[int]:
         for attempt in range(self.max_retries):
             try:
                 payload = {
                     "model": "/tank/qwen-uncensored-fp8",
                     "messages": self.build_chat_messages(text),
                     "temperature": 0.9,
-                    "max_tokens": 150,
+                    "max_tokens": self.max_tokens,
                 }
                 
                 self.logger.debug(f"Sending request to chat endpoint...")
@@ -126,7 +301,7 @@ OUTPUT FORMAT:
                 self.logger.error(f"Unexpected error in score retrieval: {e}")
                 
         self.logger.error(f"Failed to get valid score after {self.max_retries} attempts")
-        return 1
+        return fallback
 
     @staticmethod
     def extract_score(text: str) -> Optional[int]:
@@ -141,6 +316,226 @@ OUTPUT FORMAT:
             print(f"Score extraction error: {e}")
         return None
 
+    def apply_prefilter(self, records: List[Dict], output_file) -> List[Dict]:
+        """
+        Give obvious junk a low evaluation straight away and return only the
+        records that are worth an LLM call.
+        """
+        candidates = []
+        rejected = {}
+        for start in range(0, len(records), self.prefilter_batch):
+            batch = records[start:start + self.prefilter_batch]
+            with instrument.phase("prefilter"):
+                reasons = prefilter_reasons([r.get("text") or "" for r in batch], self.prefilter_thresholds)
+            for record, reason in zip(batch, reasons):
+                if reason is None:
+                    candidates.append(record)
+                    continue
+                record["evaluation"] = self.prefilter_score
+                record["evaluation_source"] = f"prefilter:{reason}"
+                rejected[reason] = rejected.get(reason, 0) + 1
+                with instrument.phase("write"):
+                    output_file.write(orjson.dumps(record).decode("utf-8") + "\n")
+
+        output_file.flush()
+        self.logger.info(f"Prefilter rated {len(records) - len(candidates)} records without the LLM: {rejected}")
+        return candidates
+
+    def train_proxy(self) -> Optional[ProxyRater]:
+        # The held-out check depends on the thresholds too, so they are part of the cache key
+        source = orjson.dumps({
+            "files": [[path, os.path.getsize(path), os.path.getmtime(path)] for path in sorted(self.proxy_train_files)],
+            "thresholds": [self.proxy_reject_below, self.proxy_accept_above],
+        }).decode("utf-8")
+        if self.proxy_model_file and os.path.exists(self.proxy_model_file):
+            model = ProxyRater.load(self.proxy_model_file)
+            # Without training files the cached model is all there is
+            if not self.proxy_train_files or model.source == source:
+                self.logger.info(f"Loaded proxy model from {self.proxy_model_file} (held out: {model.evaluation})")
+                return model
+            self.logger.info(f"{self.proxy_model_file} is out of date, retraining")
+
+        texts, labels = [], []
+        for path in self.proxy_train_files:
+            with jsonl_io.open_jsonl(path, "rb") as infile:
+                for line in infile:
+                    try:
+                        record = orjson.loads(line)
+                    except orjson.JSONDecodeError:
+                        continue
+                    rating = rating_value(record.get("evaluation"))
+                    # Only learn from real LLM ratings, not from earlier triage
+                    if rating is None or "evaluation_source" in record or not record.get("text"):
+                        continue
+                    texts.append(record["text"])
+                    labels.append(rating >= good_rating)
+
+        if len(texts) < self.proxy_min_train or len(set(labels)) < 2:
+            self.logger.warning(f"Not enough LLM ratings to train the proxy model ({len(texts)}), skipping triage")
+            return None
+        self.logger.info(f"Training proxy model on {len(texts)} ratings ({sum(labels)} good)")
+        labels = np.array(labels)
+        order = np.random.default_rng(0).permutation(len(texts))
+        held = order[:int(len(texts) * self.proxy_holdout)]
+        train = order[len(held):]
+        if len(set(labels[held])) < 2 or len(set(labels[train])) < 2:
+            self.logger.warning("Held-out set lacks good or bad ratings, skipping triage")
+            return None
+
+        model = ProxyRater().fit([texts[i] for i in train], labels[train])
+        evaluation = evaluate_proxy(model.predict_proba([texts[i] for i in held]), labels[held],
+                                    self.proxy_reject_below, self.proxy_accept_above)
+        self.logger.info(f"Proxy model on {len(held)} held-out ratings: {evaluation}")
+        if evaluation["auc"] < self.proxy_min_auc or evaluation["good_rejected"] > self.proxy_max_good_loss:
+            self.logger.warning(
+                f"Proxy model is not good enough to settle records (needs AUC >= {self.proxy_min_auc} and "
+                f"good_rejected <= {self.proxy_max_good_loss}), skipping triage"
+            )
+            return None
+
+        # Passed: the final model learns from every rating
+        model = ProxyRater().fit(texts, labels)
+        model.evaluation = orjson.dumps(evaluation).decode("utf-8")
+        if self.proxy_model_file:
+            model.save(self.proxy_model_file, source)
+        return model
+
+    def apply_proxy(self, records: List[Dict], output_file) -> List[Dict]:
+        """
+        Score every record with the proxy model, settle the confident ones and
+        return the uncertain band ordered by how likely it is to be kept.
+        """
+        with instrument.phase("proxy"):
+            model = self.train_proxy()
+            if model is None:
+                return records
+            probabilities = np.concatenate([
+                model.predict_proba([r.get("text") or "" for r in records[start:start + self.prefilter_batch]])
+                for start in range(0, len(records), self.prefilter_batch)
+            ]) if records else np.zeros(0)
+
+        uncertain = []
+        settled = 0
+        for record, probability in zip(records, probabilities):
+            if probability < self.proxy_reject_below:
+                record["evaluation"] = self.prefilter_score
+            elif self.proxy_accept_above is not None and probability > self.proxy_accept_above:
+                record["evaluation"] = self.proxy_accept_score
+            else:
+                uncertain.append((probability, record))
+                continue
+            record["evaluation_source"] = "proxy"
+            record["proxy_probability"] = round(float(probability), 4)
+            settled += 1
+            with instrument.phase("write"):
+                output_file.write(orjson.dumps(record).decode("utf-8") + "\n")
+
+        output_file.flush()
+        self.logger.info(f"Proxy model settled {settled} records, {len(uncertain)} left for the LLM")
+        # Highest expected value first: the likeliest keepers get rated before a run is cut short
+        uncertain.sort(key=lambda item: -item[0])
+        self.priority_ordered = True
+        return [record for _, record in uncertain]
+
+    def estimate_tokens(self, record: Dict) -> int:
+        """
+        Prompt tokens of the record's text: the cached count if tokenizing.py
+        stored one, otherwise a guess from the character length.
+        """
+        count = record.get(self.token_count_field)
+        if isinstance(count, int) and not isinstance(count, bool):
+            return count
+        return math.ceil(len(record.get("text") or "") / self.chars_per_token)
+
+    def text_budget(self) -> Optional[int]:
+        if self.context_window is None:
+            return None
+        return self.context_window - self.max_tokens - self.prompt_overhead
+
+    def schedule_records(self, records: List[Dict], output_file) -> List[Dict]:
+        """
+        Settle records whose prompt would not fit the context window (when
+        overflow="skip") and order the rest for dispatch. Records keep their
+        own ids, only the order they are sent (and written) in changes. After
+        the proxy, only records within the same dispatch window are reordered.
+        """
+        estimates = [self.estimate_tokens(record) for record in records]
+        budget = self.text_budget()
+        # Windowed documents never send more than window_tokens at once
+        if budget is not None and self.overflow == "skip" and self.window_tokens is None:
+            fitting = []
+            for record, estimate in zip(records, estimates):
+                if estimate <= budget:
+                    fitting.append((record, estimate))
+                    continue
+                record["evaluation"] = self.prefilter_score
+                record["evaluation_source"] = "context_window"
+                with instrument.phase("write"):
+                    output_file.write(orjson.dumps(record).decode("utf-8") + "\n")
+            output_file.flush()
+            if len(fitting) < len(records):
+                self.logger.info(f"Skipped {len(records) - len(fitting)} records longer than {budget} tokens")
+            records, estimates = [r for r, _ in fitting], [e for _, e in fitting]
+
+        if self.schedule == "longest_first":
+            # Long prompts start first so they don't end up as the run's tail
+            key = lambda i: -estimates[i]
+        elif self.schedule == "buckets":
+            # Power-of-two size classes, largest class first, input order inside a class
+            key = lambda i: -self.size_class(estimates[i])
+        else:
+            return records
+        window = self.batch_size * self.schedule_window if self.priority_ordered else max(len(records), 1)
+        order = [
+            i for start in range(0, len(records), window)
+            for i in sorted(range(start, min(start + window, len(records))), key=key)
+        ]
+        return [records[i] for i in order]
+
+    @staticmethod
+    def size_class(estimate: int) -> int:
+        return max(estimate, 1).bit_length()
+
+    def make_batches(self, records: List[Dict]) -> List[List[Dict]]:
+        """
+        Cut records into request batches. With schedule="buckets" a batch never
+        spans two size classes, so each class's remainder is its own short batch.
+        """
+        if self.schedule != "buckets":
+            return [records[i:i + self.batch_size] for i in range(0, len(records), self.batch_size)]
+        batches = []
+        for _, group in itertools.groupby(records, key=lambda r: self.size_class(self.estimate_tokens(r))):
+            group = list(group)
+            batches.extend(group[i:i + self.batch_size] for i in range(0, len(group), self.batch_size))
+        return batches
+
+    def prompt_text(self, record: Dict) -> str:
+        """
+        The record's text, cut to fit the context window when overflow="truncate".
+        """
+        text = record["text"]
+        budget = self.text_budget()
+        estimate = self.estimate_tokens(record)
+        if budget is None or estimate <= budget or self.window_tokens is not None:
+            return text
+        record["rating_truncated"] = True
+        # Same share of characters as of tokens, so a cached count is honoured
+        return text[:max(int(len(text) * budget / estimate), 0)]
+
+    async def score_windows(self, record: Dict, session: aiohttp.ClientSession) -> int:
+        """
+        Rate each window of a long document as its own request, so a failure
+        only retries that window, and aggregate the scores.
+        """
+        count = math.ceil(self.estimate_tokens(record) / self.window_tokens)
+        windows = split_windows(record["text"], count)
+        scores = await asyncio.gather(*[self.get_score_with_retries(w, session, fallback=None) for w in windows])
+        record["window_scores"] = scores
+        scores = [score for score in scores if score is not None]
+        if not scores:
+            return 1
+        return WINDOW_AGGREGATES[self.window_aggregate](scores)
+
     async def rate_batch(self, batch: List[Dict], session: aiohttp.ClientSession, output_file) -> List[Dict]:
         self.logger.info(f"Processing batch of {len(batch)} items")
         tasks = []
@@ -148,13 +543,17 @@ OUTPUT FORMAT:
         for record in batch:
             # Extract text from your specific JSON structure
             if "text" in record:
-                content = record["text"]
+                if self.window_tokens is not None and self.estimate_tokens(record) > self.window_tokens:
+                    tasks.append(self.score_windows(record, session))
+                    continue
+                content = self.prompt_text(record)
                 tasks.append(self.get_score_with_retries(content, session))
             else:
                 self.logger.warning(f"Record missing 'text' field: {record}")
                 tasks.append(None)
 
-        ratings = await asyncio.gather(*tasks, return_exceptions=True)
+        with instrument.phase("request"):
+            ratings = await asyncio.gather(*tasks, return_exceptions=True)
         processed_batch = []
         
         for record, rating in zip(batch, ratings):
@@ -166,8 +565,9 @@ OUTPUT FORMAT:
                 record["evaluation"] = rating
                 
             try:
-                output_file.write(orjson.dumps(record).decode("utf-8") + "\n")
-                output_file.flush()
+                with instrument.phase("write"):
+                    output_file.write(orjson.dumps(record).decode("utf-8") + "\n")
+                    output_file.flush()
                 processed_batch.append(record)
             except Exception as e:
                 self.logger.error(f"Error writing record: {e}")
@@ -176,6 +576,7 @@ OUTPUT FORMAT:
 
     async def process_file(self):
         self.logger.info(f"Starting file processing: {self.input_file}")
+        instrument.start("rater")
         
         # Test connection first
         print(f"Testing connection to {self.endpoint_url}...")
@@ -196,24 +597,31 @@ OUTPUT FORMAT:
         
         # Continue with regular processing
         async with aiohttp.ClientSession(headers=self.headers) as session:
-            with open(self.input_file, "r") as infile, open(self.output_file, "w") as outfile:
+            with jsonl_io.open_jsonl(self.input_file, "r") as infile, jsonl_io.open_jsonl(self.output_file, "w") as outfile:
                 # Process just a few records for initial testing
                 try:
                     records = []
                     for line in infile:
                         try:
-                            record = orjson.loads(line)
+                            with instrument.phase("parse"):
+                                record = orjson.loads(line)
                             records.append(record)
                         except Exception as e:
                             self.logger.error(f"Error parsing JSON line: {e}, Line: {line[:100]}...")
                     
                     self.logger.info(f"Total records loaded: {len(records)}")
+
+                    if self.prefilter:
+                        records = self.apply_prefilter(records, outfile)
+                    if self.proxy_train_files or self.proxy_model_file:
+                        records = self.apply_proxy(records, outfile)
+                    records = self.schedule_records(records, outfile)
                     
                     # Start with just 2 records for testing
                     test_records = records[:2]
                     self.logger.info(f"Processing first 2 test records")
                     
-                    batches = [test_records[i:i + self.batch_size] for i in range(0, len(test_records), self.batch_size)]
+                    batches = self.make_batches(test_records)
                     self.logger.info(f"Created {len(batches)} test batches")
                     
                     results = []
@@ -225,10 +633,10 @@ OUTPUT FORMAT:
                         
                     # If test is successful, ask to continue
                     if len(results) > 0:
-                        continue_all = input(f"Processed {len(results)} test records. Process all remaining records? (y/n): ")
+                        continue_all = input(f"Processed {len(results)} test records. Process all remaining records? (y/n): ") if self.confirm else "y"
                         if continue_all.lower() == 'y':
                             remaining_records = records[len(test_records):]
-                            remaining_batches = [remaining_records[i:i + self.batch_size] for i in range(0, len(remaining_records), self.batch_size)]
+                            remaining_batches = self.make_batches(remaining_records)
                             
                             self.logger.info(f"Processing remaining {len(remaining_records)} records in {len(remaining_batches)} batches")
                             
@@ -243,6 +651,7 @@ OUTPUT FORMAT:
                     print(f"Error during processing: {e}")
                 
         self.logger.info("Processing complete!")
+        instrument.report()
         return results
 
 def main():
@@ -0,0 +1,357 @@
+"""
+Run dedupe or rating across several machines.
+
+    # on every node i of N (input on shared storage, or copied over)
+    python shard.py split corpus.jsonl.zst --num-shards N --shard i --prefix work/corpus
+    python shard.py run dedupe-fuzz work/corpus.shard-0000i-of-0000N.jsonl work/deduped-i.jsonl
+
+    # on any one node, once every shard is done
+    python shard.py merge dedupe-fuzz work/deduped-*.jsonl --output deduped.jsonl
+
+    # or all of the above with local processes standing in for the nodes
+    python shard.py local dedupe-fuzz corpus.jsonl deduped.jsonl --num-shards 4
+
+Records are assigned to shards by a prefix of their content hash, so exact
+duplicates always land on the same node and every node gets an even share.
+Near-duplicates can still end up on different nodes; merge finds those
+across shards with MinHash LSH, verifies them with fuzz.ratio and keeps one
+record per cluster.
+"""
+import argparse
+import asyncio
+import glob
+import os
+import subprocess
+import sys
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing import Pool
+
+import numpy as np
+import orjson
+from tqdm import tqdm
+
+import fingerprints
+import instrument
+import jsonl_io
+from fingerprints import UnionFind, candidate_pairs, content_hash
+from stages import STAGES, load_stage
+
+text_field = "text"
+num_workers = os.cpu_count() or 1
+KEY_FIELDS = {"dedupe-basic": "content"}  # Field each stage dedupes on, when it isn't text_field
+
+
+def shard_of(text, num_shards):
+    return int.from_bytes(content_hash(text)[:8], "big") % num_shards
+
+
+def shard_path(prefix, shard, num_shards, suffix=".jsonl"):
+    return f"{prefix}.shard-{shard:05d}-of-{num_shards:05d}{suffix}"
+
+
+def split(input_path, num_shards, prefix, only=None, field=text_field, plain=False):
+    """
+    Write the records of every shard (or just shard `only`) to its own file.
+    Shards keep the input's compression unless `plain` is set.
+    """
+    suffix = ".jsonl" if plain or not jsonl_io.codec(input_path) else f".jsonl.{jsonl_io.codec(input_path)}"
+    wanted = range(num_shards) if only is None else [only]
+    os.makedirs(os.path.dirname(prefix) or ".", exist_ok=True)
+    outputs = {i: jsonl_io.open_jsonl(shard_path(prefix, i, num_shards, suffix), "wb") for i in wanted}
+    counts = dict.fromkeys(wanted, 0)
+    try:
+        with jsonl_io.open_jsonl(input_path, "rb") as infile:
+            for line in tqdm(infile, desc="Splitting"):
+                if not line.strip():
+                    continue
+                with instrument.phase("parse"):
+                    text = orjson.loads(line).get(field) or ""
+                shard = shard_of(text, num_shards)
+                if shard in outputs:
+                    outputs[shard].write(line if line.endswith(b"\n") else line + b"\n")
+                    counts[shard] += 1
+    finally:
+        for outfile in outputs.values():
+            outfile.close()
+    return {shard_path(prefix, i, num_shards, suffix): counts[i] for i in wanted}
+
+
+def parse_value(value):
+    try:
+        return orjson.loads(value)
+    except orjson.JSONDecodeError:
+        return value
+
+
+def fuzz_stage(**settings):
+    """
+    dedupe-fuzz's module, loaded only once so its functions pickle for the Pool.
+    Settings already on the module (e.g. from run()) are left alone unless given.
+    """
+    module = sys.modules.get("dedupe_fuzz")
+    if module is None:
+        return load_stage("dedupe-fuzz", **settings)
+    for key, value in settings.items():
+        if not hasattr(module, key):
+            raise AttributeError(f"Stage dedupe-fuzz has no setting {key!r}")
+        setattr(module, key, value)
+    return module
+
+
+def signature_path(output_path):
+    return output_path + ".minhash.npz"
+
+
+def compute_signatures(path):
+    """
+    MinHash signature, text length and id of every line of `path`, computed in
+    a Pool with dedupe-fuzz's cluster-mode helpers. Empty records get length 0.
+    """
+    stage = fuzz_stage()
+    with jsonl_io.plain_copy(path) as plain:
+        offsets = stage.line_offsets(plain)
+        total = len(offsets) - 1
+        step = max(1, -(-total // (num_workers * 4)))
+        ranges = [(start, min(start + step, total)) for start in range(0, total, step)]
+        with Pool(num_workers, initializer=stage.init_cluster_worker, initargs=(plain, offsets)) as pool:
+            results = pool.map(instrument.task(stage.signature_range), ranges)
+            pool.close()
+            pool.join()
+    signatures = np.zeros((total, fingerprints.num_perm), dtype=np.uint32)
+    lengths = np.zeros(total, dtype=np.int64)
+    ids = []
+    index = 0
+    for chunk_signatures, chunk_info in results:
+        for signature, (_, length, record_id) in zip(chunk_signatures, chunk_info):
+            if length:
+                signatures[index] = signature
+                lengths[index] = length
+            ids.append(record_id)
+            index += 1
+    return signatures, lengths, ids
+
+
+def run(stage, input_path, output_path, settings):
+    """
+    Run one pipeline stage (or the rater) on a single shard. dedupe-fuzz
+    nodes also leave the signatures of what they kept next to the output,
+    so merge doesn't have to recompute them for the whole corpus.
+    """
+    if stage == "rater":
+        from rater import ContentRater
+        rater = ContentRater(input_file=input_path, output_file=output_path, confirm=False, **settings)
+        asyncio.run(rater.process_file())
+        return
+    module = load_stage(stage, input_file=input_path, output_file=output_path, **settings)
+    module.main()
+    if stage == "dedupe-fuzz":
+        signatures, lengths, ids = compute_signatures(output_path)
+        with open(signature_path(output_path), "wb") as outfile:
+            # Only cluster mode compares every pair within the shard; merge rechecks the rest
+            np.savez(outfile, signatures=signatures, lengths=lengths, ids=orjson.dumps(ids).decode(),
+                     settled=module.mode == "cluster")
+
+
+def load_signatures(path):
+    sidecar = signature_path(path)
+    if os.path.exists(sidecar) and os.path.getmtime(sidecar) >= os.path.getmtime(path):
+        data = np.load(sidecar)
+        if "ids" in data:
+            return data["signatures"], data["lengths"], orjson.loads(str(data["ids"])), bool(data["settled"])
+    print(f"No signatures for {path}, computing them")
+    # Without the sidecar, don't assume the node compared all pairs within its shard
+    return (*compute_signatures(path), False)
+
+
+def merge(stage, inputs, output_path, cluster_map=None, settings=None):
+    """
+    Concatenate shard outputs in shard order. For dedupe-fuzz, also drop
+    near-duplicates that ended up on different shards, and within shards whose
+    node ran chunked (exact duplicates never cross shards, so the other stages
+    only need the concatenation). `settings` are the
+    dedupe-fuzz settings the nodes ran with (similarity_threshold, keep, ...).
+    """
+    if stage != "dedupe-fuzz" or len(inputs) < 2:
+        total = 0
+        with instrument.phase("write"), jsonl_io.open_jsonl(output_path, "wb") as outfile:
+            for path in inputs:
+                with jsonl_io.open_jsonl(path, "rb") as infile:
+                    for line in infile:
+                        if line.strip():
+                            outfile.write(line if line.endswith(b"\n") else line + b"\n")
+                            total += 1
+        print(f"Merged {total} records from {len(inputs)} shards")
+        return total
+
+    signatures, lengths, shards, ids, settled = [], [], [], [], []
+    for shard, path in enumerate(inputs):
+        shard_signatures, shard_lengths, shard_ids, shard_settled = load_signatures(path)
+        signatures.append(shard_signatures)
+        lengths.append(shard_lengths)
+        shards.append(np.full(len(shard_lengths), shard))
+        ids.extend(shard_ids)
+        settled.append(shard_settled)
+    settled = np.array(settled, dtype=bool)
+    signatures, lengths, shards = np.concatenate(signatures), np.concatenate(lengths), np.concatenate(shards)
+    print(f"Merging {len(lengths)} records from {len(inputs)} shards")
+    fuzz = fuzz_stage(**(settings or {}))
+
+    with tempfile.TemporaryDirectory(dir=os.path.dirname(os.path.abspath(output_path))) as scratch:
+        # One plain file of all shards, so workers can read records by line from an mmap
+        merged = os.path.join(scratch, "merged.jsonl")
+        with open(merged, "wb") as outfile:
+            for path in inputs:
+                with jsonl_io.open_jsonl(path, "rb") as infile:
+                    for line in infile:
+                        outfile.write(line if line.endswith(b"\n") else line + b"\n")
+        offsets = fuzz.line_offsets(merged)
+        if len(offsets) - 1 != len(lengths):
+            raise ValueError("Signature files don't match the shard outputs, delete the *.minhash.npz files")
+
+        with instrument.phase("compute"):
+            valid = np.flatnonzero(lengths > 0)
+            pairs = valid[candidate_pairs(signatures[valid])] if len(valid) else np.empty((0, 2), dtype=np.int64)
+            # Pairs inside one shard were settled by nodes that ran in cluster mode;
+            # chunked mode only compares records within a chunk, so those shards are rechecked
+            same = shards[pairs[:, 0]] == shards[pairs[:, 1]]
+            pairs = pairs[~same | ~settled[shards[pairs[:, 0]]]]
+        del signatures
+        print(f"{len(pairs)} candidate pairs ({int((~settled).sum())} of {len(inputs)} shards ran chunked)")
+
+        chunks = [pairs[i:i + 1000] for i in range(0, len(pairs), 1000)]
+        with Pool(num_workers, initializer=fuzz.init_cluster_worker, initargs=(merged, offsets)) as pool:
+            verified = pool.map(instrument.task(fuzz.verify_pairs), chunks)
+            pool.close()
+            pool.join()
+
+        union = UnionFind(len(lengths))
+        for chunk, mask in zip(chunks, verified):
+            for a, b in chunk[mask]:
+                union.union(int(a), int(b))
+        info = [(None, int(length), record_id) for length, record_id in zip(lengths, ids)]  # As in dedupe-fuzz
+        kept = []
+        clusters = {}
+        for members in union.clusters().values():
+            members = [i for i in members if lengths[i]]  # Empty records are dropped, as in dedupe-fuzz
+            if not members:
+                continue
+            # Same rule as the nodes (keep setting), earliest (shard, line) breaks ties
+            representative = fuzz.pick_representative(members, info)
+            kept.append(representative)
+            if len(members) > 1:
+                clusters[representative] = [i for i in members if i != representative]
+        kept.sort()
+        print(f"Dropped {len(lengths) - len(kept)} near-duplicates and empty records")
+
+        with instrument.phase("write"), jsonl_io.open_jsonl(output_path, "wb") as outfile:
+            data = fuzz.open_source(merged, offsets)
+            for index in kept:
+                outfile.write(data[offsets[index]:offsets[index + 1]])
+            del data
+            fuzz._source = None
+
+    if cluster_map:
+        with jsonl_io.open_jsonl(cluster_map, "wb") as outfile:
+            for representative, duplicates in sorted(clusters.items()):
+                outfile.write(orjson.dumps({
+                    "kept": {"shard": int(shards[representative]), "merged_line": representative + 1},
+                    "removed": [{"shard": int(shards[i]), "merged_line": i + 1} for i in duplicates],
+                }, option=orjson.OPT_APPEND_NEWLINE))
+    return len(kept)
+
+
+def local(stage, input_path, output_path, num_shards, workdir, settings):
+    """
+    Simulate a multi-node run: one subprocess per shard doing split + run,
+    then a merge here.
+    """
+    os.makedirs(workdir, exist_ok=True)
+    prefix = os.path.join(workdir, "input")
+    script = os.path.abspath(__file__)
+    extra = [arg for key, value in settings.items() for arg in ("--set", f"{key}={orjson.dumps(value).decode()}")]
+    nodes = []
+    for shard in range(num_shards):
+        shard_input = shard_path(prefix, shard, num_shards, ".jsonl")
+        shard_output = os.path.join(workdir, f"output-{shard:05d}.jsonl")
+        # Each node gets its own directory for logs and side files like clusters.jsonl
+        node_dir = os.path.join(workdir, f"node-{shard:05d}")
+        os.makedirs(node_dir, exist_ok=True)
+        commands = [
+            [sys.executable, script, "split", input_path, "--num-shards", str(num_shards), "--shard", str(shard),
+             "--prefix", prefix, "--field", KEY_FIELDS.get(stage, text_field), "--plain"],
+            [sys.executable, script, "run", stage, shard_input, shard_output, *extra],
+        ]
+        nodes.append((shard_output, commands, node_dir))
+
+    def run_node(node):
+        _, commands, node_dir = node
+        return all(subprocess.run(command, cwd=node_dir).returncode == 0 for command in commands)
+
+    with ThreadPoolExecutor(num_shards) as executor:
+        succeeded = list(executor.map(run_node, nodes))
+    failed = [shard for shard, ok in enumerate(succeeded) if not ok]
+    if failed:
+        raise SystemExit(f"Shards {failed} failed")
+    return merge(stage, [path for path, _, _ in nodes], output_path, os.path.join(workdir, "clusters.jsonl"),
+                 settings if stage == "dedupe-fuzz" else None)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Hash-sharded multi-node dedupe and rating")
+    commands = parser.add_subparsers(dest="command", required=True)
+    stages = list(STAGES) + ["rater"]
+
+    p = commands.add_parser("split", help="Partition an input file by content hash")
+    p.add_argument("input")
+    p.add_argument("--num-shards", type=int, required=True)
+    p.add_argument("--shard", type=int, help="Only write this shard (one node's share)")
+    p.add_argument("--prefix", required=True)
+    p.add_argument("--field", default=text_field, help="Field to hash (dedupe-basic uses \"content\")")
+    p.add_argument("--plain", action="store_true", help="Write uncompressed shards")
+
+    p = commands.add_parser("run", help="Run a stage on one shard")
+    p.add_argument("stage", choices=stages)
+    p.add_argument("input")
+    p.add_argument("output")
+    p.add_argument("--set", action="append", default=[], metavar="KEY=VALUE",
+                   help="Stage setting (module variable, or ContentRater argument for the rater)")
+
+    p = commands.add_parser("merge", help="Combine shard outputs")
+    p.add_argument("stage", choices=stages)
+    p.add_argument("inputs", nargs="+")
+    p.add_argument("--output", required=True)
+    p.add_argument("--cluster-map", help="Write cross-shard duplicate clusters here")
+    p.add_argument("--set", action="append", default=[], metavar="KEY=VALUE",
+                   help="dedupe-fuzz setting the nodes ran with (similarity_threshold, keep, ...)")
+
+    p = commands.add_parser("local", help="Split, run and merge with local processes as nodes")
+    p.add_argument("stage", choices=stages)
+    p.add_argument("input")
+    p.add_argument("output")
+    p.add_argument("--num-shards", type=int, default=4)
+    p.add_argument("--workdir", default="shards")
+    p.add_argument("--set", action="append", default=[], metavar="KEY=VALUE")
+
+    args = parser.parse_args()
+    settings = {}
+    for item in getattr(args, "set", []):
+        key, _, value = item.partition("=")
+        settings[key] = parse_value(value)
+
+    if args.command == "split":
+        written = split(args.input, args.num_shards, args.prefix, args.shard, args.field, args.plain)
+        for path, count in written.items():
+            print(f"{path}: {count} records")
+    elif args.command == "run":
+        run(args.stage, args.input, args.output, settings)
+    elif args.command == "merge":
+        inputs = sorted(path for pattern in args.inputs for path in (glob.glob(pattern) or [pattern]))
+        merge(args.stage, inputs, args.output, args.cluster_map, settings)
+    else:
+        local(args.stage, os.path.abspath(args.input), os.path.abspath(args.output), args.num_shards,
+              os.path.abspath(args.workdir), settings)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,35 @@
+import importlib.util
+import os
+import sys
+
+# Pipeline stages in the order they run, mapped to their scripts
+STAGES = {
+    "prune": "prune.py",
+    "lang-filter": "lang-filter.py",
+    "tokenizing": "tokenizing.py",
+    "dedupe-basic": "dedupe-basic.py",
+    "dedupe-fuzz": "dedupe-fuzz.py",
+    "dedupe-substring": "dedupe-substring.py",
+    "extract": "Extract.py",
+}
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+
+
+def load_stage(name, **overrides):
+    """
+    Import a stage script by name and override its module-level settings
+    (input_file, output_file, num_workers, ...). The module is registered in
+    sys.modules so Pool workers can unpickle functions defined in it.
+    """
+    module_name = name.replace("-", "_")
+    spec = importlib.util.spec_from_file_location(module_name, os.path.join(ROOT, STAGES[name]))
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[module_name] = module
+    spec.loader.exec_module(module)
+
+    for key, value in overrides.items():
+        if not hasattr(module, key):
+            raise AttributeError(f"Stage {name} has no setting {key!r}")
+        setattr(module, key, value)
+    return module
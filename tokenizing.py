@@ -1,55 +1,93 @@
-from transformers import AutoTokenizer
+import os
+from tokenizers import Tokenizer
 import orjson  # for speed
 from tqdm import tqdm
-from multiprocessing import Pool
+import multiprocessing
+
+import instrument
+import jsonl_io
 
 input_file = "filtered_file.jsonl"
 output_file = "tokenized-ass.jsonl"
 model_name = "Orion-zhen/Qwen2.5-14B-Instruct-Uncensored"  # Change this to whatever HF model you're using
+tokenizer_file = None  # Local tokenizer.json, skips the Hub lookup for model_name
 max_tokens = 32768
+token_count_field = None  # e.g. "token_count" to keep each record's count for rater.py's scheduler
+num_workers = 12  # Use all those 12 cores you're so proud of
+
+tokenizer = None
+
+
+def load_tokenizer():
+    if tokenizer_file:
+        return Tokenizer.from_file(tokenizer_file)
+    return Tokenizer.from_pretrained(model_name)
 
 
-# Load your tokenizer only once for each worker
+# Only does anything where workers can't be forked; with fork they share the parent's tokenizer
 def init_worker():
     global tokenizer
-    tokenizer = AutoTokenizer.from_pretrained(model_name, use_fast=True)
+    instrument.worker_init()
+    if tokenizer is None:
+        with instrument.phase("startup"):
+            tokenizer = load_tokenizer()
 
 
 def process_line(line):
     try:
-        record = orjson.loads(line)
+        with instrument.phase("parse"):
+            record = orjson.loads(line)
         content = record.get("text", "")
 
         if not content:  # Skip entries with blank content
             return None
 
         # Tokenize and check length
-        token_count = len(tokenizer.encode(content, add_special_tokens=False))
+        with instrument.phase("compute"):
+            token_count = len(tokenizer.encode(content, add_special_tokens=False))
         if token_count <= max_tokens:
+            if token_count_field:
+                record[token_count_field] = token_count
             return orjson.dumps(record).decode("utf-8")
     except Exception:
         return None  # Skip problematic entries
 
 
 def main():
-    with open(input_file, "r") as infile:
+    global tokenizer
+    instrument.start("tokenizing")
+    # The Rust thread pool must not be live when the workers are forked
+    os.environ.setdefault("TOKENIZERS_PARALLELISM", "false")
+
+    # Load once here; forked workers get it copy-on-write instead of loading it 12 times
+    if "fork" in multiprocessing.get_all_start_methods():
+        context = multiprocessing.get_context("fork")
+        with instrument.phase("startup"):
+            tokenizer = load_tokenizer()
+    else:
+        context = multiprocessing.get_context()
+
+    with instrument.phase("read"), jsonl_io.open_jsonl(input_file, "r") as infile:
         lines = infile.readlines()
 
-    num_workers = 12  # Use all those 12 cores you're so proud of
-    with Pool(num_workers, initializer=init_worker) as pool:
+    with context.Pool(num_workers, initializer=init_worker) as pool:
         results = list(
             tqdm(
-                pool.imap(process_line, lines),
+                pool.imap(instrument.task(process_line), lines),
                 desc="Filtering based on token limit",
                 total=len(lines),
             )
         )
+        pool.close()
+        pool.join()
 
-    with open(output_file, "w") as outfile:
+    with instrument.phase("write"), jsonl_io.open_jsonl(output_file, "w") as outfile:
         for result in results:
             if result:
                 outfile.write(result + "\n")
 
+    instrument.report()
+
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()